@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+
+# Runs the benchmarks and saves the results in .benchmarks.
+# If there are previous results, fails if the minimum time of any benchmark
+# got more than 25% worse than the last saved run.
+
+set -eux
+
+compare=""
+if [ -d .benchmarks ]; then
+    compare="--benchmark-compare --benchmark-compare-fail=min:25%"
+fi
+
+python -m pytest benchmarks --benchmark-autosave $compare "$@"
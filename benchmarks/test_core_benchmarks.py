@@ -0,0 +1,150 @@
+"""
+Benchmarks of the hot paths in friendly_states.core.
+
+Run with ./bench.sh to save the results and compare them with the previous run.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.core import AttributeState, MappingKeyState, StateMeta, extract_state_names
+from friendly_states.exceptions import IncorrectInitialState
+from friendly_states.synthetic import generate_machine
+
+pytestmark = pytest.mark.benchmark(group="core")
+
+
+@pytest.mark.parametrize("n", [10, 100, 1000])
+def test_complete(benchmark, n):
+    def setup():
+        generated = generate_machine(n, fan_out=3, abstract_layers=2, complete=False)
+        return (generated.machine,), {}
+
+    benchmark.pedantic(StateMeta.complete, setup=setup, rounds=20)
+
+
+def test_check_summary(benchmark):
+    generated = generate_machine(1000, fan_out=3, abstract_layers=2)
+    benchmark(generated.machine.check_summary, generated.Summary)
+
+
+def test_extract_state_names(benchmark):
+    result = benchmark(extract_state_names, "[Yellow, Red, module.Green]")
+    assert result == ["Yellow", "Red", "Green"]
+
+
+@pytest.fixture(scope="module")
+def light():
+    return generate_machine(3).states
+
+
+def test_instantiate(benchmark, light):
+    green = light[0]
+    obj = SimpleNamespace(state=green)
+    benchmark(green, obj)
+
+
+def test_instantiate_abstract(benchmark, light):
+    green = light[0]
+    obj = SimpleNamespace(state=green)
+    benchmark(green.machine, obj)
+
+
+def test_get_and_check_state(benchmark, light):
+    green = light[0]
+    instance = green(SimpleNamespace(state=green))
+    benchmark(instance._get_and_check_state, ValueError, "")
+
+
+@pytest.mark.parametrize("base", [AttributeState, MappingKeyState])
+def test_transition(benchmark, base):
+    green, yellow, red = generate_machine(3, base=base).states
+    obj = SimpleNamespace(state=green) if base is AttributeState else dict(state=green)
+
+    def cycle():
+        green(obj).t0()
+        yellow(obj).t0()
+        red(obj).t0()
+
+    benchmark(cycle)
+
+
+@pytest.mark.parametrize("base", [AttributeState, MappingKeyState])
+def test_batch_transition(benchmark, base):
+    green, yellow, red = generate_machine(3, base=base).states
+    make = (lambda: SimpleNamespace(state=green)) if base is AttributeState else (lambda: dict(state=green))
+    objs = [make() for _ in range(1000)]
+
+    def cycle():
+        for state in [green, yellow, red]:
+            for obj in objs:
+                state(obj).t0()
+
+    benchmark(cycle)
+
+
+@pytest.mark.parametrize("slots", [False, True])
+def test_reused_instance(benchmark, slots):
+    generated = generate_machine(3, slots=slots)
+    green = generated.states[0]
+    obj = SimpleNamespace(state=green)
+    state = generated.machine(obj)
+
+    def cycle():
+        state.t0()
+        state.t0()
+        state.t0()
+
+    benchmark(cycle)
+
+
+class ExpensiveRepr:
+    """
+    Like a Django model whose __str__ does queries.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __repr__(self):
+        return "".join(str(i) for i in range(100))
+
+
+@pytest.mark.parametrize("formatted", [False, True], ids=["caught", "formatted"])
+def test_rejection(benchmark, light, formatted):
+    green, yellow, _ = light
+    obj = ExpensiveRepr(green)
+
+    def reject():
+        try:
+            yellow(obj)
+        except IncorrectInitialState as e:
+            if formatted:
+                str(e)
+
+    benchmark(reject)
+
+
+def test_try_transition_rejected(benchmark, light):
+    green, yellow, _ = light
+    obj = ExpensiveRepr(green)
+    assert benchmark(yellow.machine.try_transition, obj, yellow.t0) is None
+
+
+def test_allowed(benchmark, light):
+    green = light[0]
+    obj = SimpleNamespace(state=green)
+    assert benchmark(green.machine.allowed, obj) == {green.t0}
+
+
+def test_dispatch(benchmark, light):
+    green = light[0]
+    machine = green.machine
+    obj = SimpleNamespace(state=green)
+
+    def cycle():
+        machine.dispatch(obj, "t0")
+        machine.dispatch(obj, "t0")
+        machine.dispatch(obj, "t0")
+
+    benchmark(cycle)
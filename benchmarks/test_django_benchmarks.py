@@ -0,0 +1,47 @@
+"""
+Benchmarks of DjangoState transitions on SQLite.
+See also test_state_field.py for StateField conversions.
+
+Run with ./bench.sh to save the results and compare them with the previous run.
+"""
+import pytest
+
+from myapp.models import MyModel, Green, Yellow, Red
+
+pytestmark = pytest.mark.benchmark(group="django")
+
+
+@pytest.mark.django_db
+def test_transition(benchmark):
+    obj = MyModel.objects.create(state=Green)
+
+    def cycle():
+        Green(obj).to_yellow()
+        Yellow(obj).to_red()
+        Red(obj).to_green()
+
+    benchmark(cycle)
+
+
+@pytest.mark.django_db
+def test_batch_transition(benchmark):
+    objs = [MyModel.objects.create(state=Green) for _ in range(100)]
+
+    def cycle():
+        for transition in [Green.to_yellow, Yellow.to_red, Red.to_green]:
+            for obj in objs:
+                transition(obj.state(obj))
+
+    benchmark(cycle)
+
+
+@pytest.mark.django_db
+def test_bulk_transition(benchmark):
+    objs = [MyModel.objects.create(state=Green) for _ in range(100)]
+
+    def cycle():
+        for transition in [Green.to_yellow, Yellow.to_red, Red.to_green]:
+            result = MyModel.objects.bulk_transition([(obj, transition) for obj in objs])
+            assert not result.errors
+
+    benchmark(cycle)
@@ -0,0 +1,95 @@
+"""
+Benchmarks of StateField conversions against the original implementation,
+which is kept here as LegacyStateField for comparison.
+
+Run with:
+
+    pytest benchmarks/test_state_field.py
+"""
+import pytest
+from django.core.exceptions import ValidationError
+
+from friendly_states.core import StateMeta
+from friendly_states.django import StateField
+from myapp.models import TrafficLightMachine, Green, Yellow, Red
+
+pytestmark = pytest.mark.benchmark(group="state-field")
+
+
+class LegacyStateField(StateField):
+    # noinspection PyUnusedLocal
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def get_prep_value(self, value):
+        machine = self.machine
+        if isinstance(value, StateMeta):
+            if value not in machine.states:
+                raise ValidationError(
+                    f"{value} is a state class but isn't one of the states "
+                    f"in the machine {machine.__name__}, which are "
+                    f"{sorted(machine.states)}",
+                )
+            return value.slug
+        elif isinstance(value, str):
+            if value not in machine.slug_to_state:
+                raise ValidationError(
+                    f"{value} is not one of the valid slugs for this machine: "
+                    f"{sorted(state.slug for state in machine.states)}",
+                )
+        elif value is not None:
+            raise ValidationError(
+                f"{self.name} should be a state class, a string, or None, not {value}",
+            )
+
+        return value
+
+
+ROWS = 10000
+SLUGS = [state.slug for state in [Green, Yellow, Red]] * (ROWS // 3)
+STATES = [Green, Yellow, Red] * (ROWS // 3)
+
+fields = pytest.mark.parametrize(
+    "field_class",
+    [StateField, LegacyStateField],
+    ids=["current", "legacy"],
+)
+
+
+@fields
+def test_from_db_value(benchmark, field_class):
+    field = field_class(TrafficLightMachine)
+    from_db_value = field.from_db_value
+
+    result = benchmark(lambda: [from_db_value(slug, None, None) for slug in SLUGS])
+    assert result[:3] == [Green, Yellow, Red]
+
+
+@fields
+def test_get_prep_value_states(benchmark, field_class):
+    field = field_class(TrafficLightMachine)
+    get_prep_value = field.get_prep_value
+
+    result = benchmark(lambda: [get_prep_value(state) for state in STATES])
+    assert result == SLUGS
+
+
+@fields
+def test_get_prep_value_slugs(benchmark, field_class):
+    field = field_class(TrafficLightMachine)
+    get_prep_value = field.get_prep_value
+
+    result = benchmark(lambda: [get_prep_value(slug) for slug in SLUGS])
+    assert result == SLUGS
+
+
+def test_to_states(benchmark):
+    field = StateField(TrafficLightMachine)
+    result = benchmark(field.to_states, SLUGS)
+    assert result == STATES
+
+
+def test_to_slugs(benchmark):
+    field = StateField(TrafficLightMachine)
+    result = benchmark(field.to_slugs, STATES)
+    assert result == SLUGS
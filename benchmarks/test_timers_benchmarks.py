@@ -0,0 +1,52 @@
+"""
+Benchmarks of TimeoutScheduler with many pending timeouts.
+
+Run with ./bench.sh to save the results and compare them with the previous run.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.synthetic import generate_machine
+from friendly_states.timers import TimeoutScheduler
+
+pytestmark = pytest.mark.benchmark(group="timers")
+
+N = 100000
+
+
+@pytest.fixture(scope="module")
+def machine():
+    generated = generate_machine(2, complete=False)
+    first = generated.states[0]
+    first.timeout = 10
+    first.on_timeout = "t0"
+    generated.machine.complete()
+    return generated.machine
+
+
+def test_schedule(benchmark, machine):
+    (first,) = machine.timeouts
+    objs = [SimpleNamespace(state=first) for _ in range(N)]
+
+    def schedule():
+        scheduler = TimeoutScheduler(machine, clock=lambda: 0)
+        for i, obj in enumerate(objs):
+            scheduler.schedule(obj, entered_at=i % 1000)
+
+    benchmark.pedantic(schedule, rounds=5)
+
+
+def test_fire(benchmark, machine):
+    (first,) = machine.timeouts
+
+    def setup():
+        scheduler = TimeoutScheduler(machine, clock=lambda: 0)
+        for i in range(N):
+            scheduler.schedule(SimpleNamespace(state=first), entered_at=i % 1000)
+        return (scheduler,), {}
+
+    def fire(scheduler):
+        assert len(scheduler.fire(now=509)) == N // 2
+
+    benchmark.pedantic(fire, setup=setup, rounds=5)
@@ -1,3 +1,3 @@
-from .core import AttributeState, MappingKeyState, BaseState
+from .core import AttributeState, MappingKeyState, BaseState, guard
 
 __version__ = '0.2.0'
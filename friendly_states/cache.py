@@ -0,0 +1,161 @@
+"""
+Caching for machines whose get_state is expensive, e.g. a request to another service.
+
+Add `CachedState` before the base class of the machine and give the machine a `StateCache`:
+
+```python
+class MyMachine(CachedState, KeyValueState):
+    is_machine = True
+    client = ...
+    cache = StateCache(maxsize=10_000, ttl=60)
+```
+
+Then instantiating a state looks in the cache first, so that a transition only reads the backend once, for the check right before the state is changed. That check right before the transition always reads the backend (and updates the cache), so a cached state which is out of date, or a transition which changes the state itself, raises `StateChangedElsewhere` instead of being overwritten, even with backends such as `AttributeState` which don't check anything when writing. Instantiating a state from an out of date entry can still raise `IncorrectInitialState` until the entry is refreshed or expires. If writing raises an error, the entry is removed so that the next read goes to the backend. `MyMachine.refresh(obj)` always reads the backend and updates the cache.
+
+While the backend defers writes, e.g. in `friendly_states.kv.bulk_transition`, the cache is bypassed: transitions invalidate their entries, and the backend reports the outcome of each write once the batch has been written, which stores the new state in the cache or leaves the entry out if the write failed.
+
+Entries are keyed by `cache_key()`, which is the object itself by default, so objects must be hashable and compare equal when they represent the same entity, as e.g. IDs do. For other objects, override `cache_key` to return e.g. `self.obj.id`. The cache keeps at most `maxsize` entries, evicting the least recently used, and entries expire after `ttl` seconds if given. `cache.hits` and `cache.misses` count lookups for monitoring.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from friendly_states.core import BaseState, StateMeta
+
+_MISSING = object()
+
+# True while CachedState.get_state must read the backend, see _fresh_reads
+_reading_backend: ContextVar = ContextVar("_reading_backend", default=False)
+
+
+class StateCache:
+    """
+    A thread-safe LRU cache with optional expiry after ttl seconds, measured by clock.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedState(BaseState):
+    __doc__ = globals()["__doc__"]
+
+    __slots__ = ()
+    cache: StateCache = None
+
+    def cache_key(self):
+        """
+        Returns the key of obj in the cache, by default obj itself, which must be hashable.
+        """
+        try:
+            hash(self.obj)
+        except TypeError:
+            raise TypeError(
+                f"{self.obj!r} can't be a cache key as it isn't hashable, "
+                f"override cache_key to return e.g. its ID"
+            ) from None
+        return self.obj
+
+    @classmethod
+    def refresh(cls, obj):
+        """
+        Reads the state of obj from the backend, bypassing the cache,
+        stores it in the cache and returns it.
+        """
+        cls._stored(obj, None)
+        instance = cls.__new__(cls)
+        instance.obj = obj
+        return instance.get_state()
+
+    @classmethod
+    def _stored(cls, obj, state):
+        instance = cls.__new__(cls)
+        instance.obj = obj
+        key = instance.cache_key()
+        if state is None:
+            instance.cache.invalidate(key)
+        else:
+            instance.cache.set(key, state)
+
+    def get_state(self):
+        if self._saving_deferred():
+            # The backend knows the state in the batch
+            return super().get_state()
+
+        key = self.cache_key()
+        if _reading_backend.get():
+            state = _MISSING
+        else:
+            state = self.cache.get(key, _MISSING)
+        if state is _MISSING:
+            state = super().get_state()
+            if isinstance(state, StateMeta):
+                self.cache.set(key, state)
+            else:
+                self.cache.invalidate(key)
+        return state
+
+    @contextmanager
+    def _fresh_reads(self):
+        token = _reading_backend.set(True)
+        try:
+            with super()._fresh_reads():
+                yield
+        finally:
+            _reading_backend.reset(token)
+
+    def set_state(self, previous_state, new_state):
+        key = self.cache_key()
+        if self._saving_deferred():
+            # Nothing has been written yet, the backend calls _stored when it has
+            self.cache.invalidate(key)
+            super().set_state(previous_state, new_state)
+            return
+
+        try:
+            super().set_state(previous_state, new_state)
+        except BaseException:
+            # The cached state may be wrong, or the write may have partly happened
+            self.cache.invalidate(key)
+            raise
+        self.cache.set(key, new_state)
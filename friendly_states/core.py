@@ -2,11 +2,14 @@ import ast
 import functools
 import inspect
 from abc import ABCMeta, abstractmethod
-from typing import Type
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Type, NamedTuple, Dict, List, Tuple, FrozenSet, Callable, Any
 
 from friendly_states.exceptions import IncorrectSummary, InheritedFromState, CannotInferOutputState, \
-    DuplicateStateNames, DuplicateOutputStates, UnknownOutputState, ReturnedInvalidState, GetStateDidNotReturnState
-from .exceptions import StateChangedElsewhere, IncorrectInitialState, MultipleMachineAncestors
+    DuplicateStateNames, DuplicateStateCodes, DuplicateOutputStates, UnknownOutputState, ReturnedInvalidState, GetStateDidNotReturnState
+from .exceptions import StateChangedElsewhere, IncorrectInitialState, MultipleMachineAncestors, TransitionNotAvailable, \
+    GuardFailed
 from .utils import snake
 
 
@@ -14,7 +17,11 @@ class StateMeta(ABCMeta):
     subclasses = None
     name_to_state = None
     slug_to_state = None
+    code_to_state = None
     states = None
+    adjacency = None
+    dispatch_table = None
+    timeouts = None
     direct_transitions = None
     is_complete = False
     machine = None
@@ -27,6 +34,21 @@ class StateMeta(ABCMeta):
         the real work happens in complete()
         """
 
+        # If the machine declares __slots__, give its subclasses empty slots
+        # so that instances don't get a __dict__
+        if any(
+                isinstance(base, StateMeta)
+                and base.machine is not None
+                and "__slots__" in base.machine.__dict__
+                for base in bases
+        ):
+            if attrs.get("__slots__", ()):
+                raise ValueError(
+                    "Classes in a machine with __slots__ cannot declare their own slots, "
+                    "as all states must have the same layout.",
+                )
+            attrs = dict(attrs, __slots__=())
+
         cls: StateMeta = super().__new__(mcs, name, bases, attrs)
 
         if cls.is_complete:
@@ -118,6 +140,26 @@ class StateMeta(ABCMeta):
                 slug_to_state=sorted(slug_to_state),
             )
 
+        cls.code_to_state = {}
+        codes = [(state.code, state) for state in cls.states if state.code is not None]
+        if codes:
+            if len(codes) != len(cls.states):
+                raise ValueError(
+                    "Either all states or none of the states in a machine should have a code."
+                )
+            for code, state in codes:
+                if not (isinstance(code, int) and code >= 0) or isinstance(code, bool):
+                    raise ValueError(
+                        f"The code {code!r} of {state} is invalid. "
+                        f"Codes should be non-negative integers."
+                    )
+            cls.code_to_state = dict(codes)
+            if len(cls.code_to_state) != len(codes):
+                raise DuplicateStateCodes(
+                    "Some of the states in this machine have the same code: {codes}",
+                    codes=sorted(codes),
+                )
+
         for sub in cls.subclasses:
             transitions = []
             for method_name, func in list(sub.__dict__.items()):
@@ -142,6 +184,90 @@ class StateMeta(ABCMeta):
 
             sub.direct_transitions = frozenset(transitions)
 
+        # The graph can't change once the machine is complete,
+        # so cache it instead of walking the MRO every time
+        for sub in cls.subclasses:
+            sub._transitions = sub.transitions
+        for state in cls.states:
+            state._output_states = state.output_states
+
+        # Maps (state, transition name) to the transition,
+        # with the names resolved along the MRO like getattr
+        cls.dispatch_table = {}
+        for state in cls.states:
+            for ancestor in reversed(state.__mro__):
+                if ancestor not in cls.subclasses:
+                    continue
+                for method_name, func in ancestor.__dict__.items():
+                    if inspect.isfunction(func) and func in ancestor.direct_transitions:
+                        cls.dispatch_table[state, method_name] = func
+
+        cls.timeouts = {}
+        for state in cls.states:
+            if state.timeout is None:
+                continue
+            transition = cls.dispatch_table.get((state, state.on_timeout))
+            if transition is None:
+                raise TransitionNotAvailable(
+                    "The state {state} has a timeout but on_timeout = {name} "
+                    "is not the name of one of its transitions",
+                    state=state,
+                    name=state.on_timeout,
+                )
+            timeout = state.timeout
+            if hasattr(timeout, "total_seconds"):
+                timeout = timeout.total_seconds()
+            if not timeout > 0:
+                # A cycle of zero timeouts would fire forever
+                raise ValueError(f"The timeout of {state} must be positive, not {state.timeout!r}")
+            cls.timeouts[state] = (timeout, transition)
+
+        for state in cls.states:
+            submachine = state.submachine
+            if submachine is None:
+                continue
+            if not (isinstance(submachine, StateMeta) and submachine.is_machine and submachine.is_complete):
+                raise ValueError(
+                    f"The submachine of {state} must be the root of a complete machine, "
+                    f"but it is {submachine!r}"
+                )
+            if submachine is cls:
+                raise ValueError(f"The submachine of {state} can't be its own machine")
+            if state.initial_substate not in submachine.states:
+                raise ValueError(
+                    f"The initial_substate of {state} must be a state of {submachine}, "
+                    f"but it is {state.initial_substate!r}"
+                )
+            if state.final_substate is not None and state.final_substate not in submachine.states:
+                raise ValueError(
+                    f"The final_substate of {state} must be None or a state of {submachine}, "
+                    f"but it is {state.final_substate!r}"
+                )
+
+            # The (submachine, initial substate) pairs to set when entering the state,
+            # outermost first. The submachine is complete so its chains are known.
+            state._entry_chain = (
+                ((submachine, state.initial_substate),)
+                + state.initial_substate._entry_chain
+            )
+
+            # Each machine needs its own storage on the object
+            attr_names = [
+                machine.attr_name
+                for machine in [cls] + [machine for machine, _ in state._entry_chain]
+                if getattr(machine, "attr_name", None) is not None
+            ]
+            if len(set(attr_names)) != len(attr_names):
+                raise ValueError(
+                    f"{cls} and the submachines of {state} must store their states "
+                    f"in different attributes, but their attr_names are {attr_names}"
+                )
+
+        cls.adjacency = {
+            state.__name__: frozenset(output.__name__ for output in state.output_states)
+            for state in cls.states
+        }
+
         summary = cls.__dict__.get("Summary")
         if summary:
             cls.check_summary(summary)
@@ -180,8 +306,19 @@ class StateMeta(ABCMeta):
                 name=e.args[0],
             ) from e
 
+        guards = tuple(getattr(func, "guards", ()))
+
         @functools.wraps(func)
         def wrapper(self: BaseState, *args, **kwargs):
+            for g in guards:
+                if not g.predicate(self.obj):
+                    raise GuardFailed(
+                        "The guard {guard} of the transition {func} rejected {obj}",
+                        guard=g,
+                        func=func,
+                        obj=self.obj,
+                    )
+
             result: 'Type[BaseState]' = func(self, *args, **kwargs)
             if result is None:
                 # Infer the next state based on the annotation
@@ -209,9 +346,22 @@ class StateMeta(ABCMeta):
                 "Did you change the state inside a transition method? Don't."
             )
 
-            self.set_state(current, result)
+            if current is not result and (current.submachine or result.submachine):
+                # Store the state and the substates together if the backend can
+                with self._write_together():
+                    self.set_state(current, result)
+                    current._exit_submachine(self.obj)
+                    result._enter_submachine(self.obj)
+            else:
+                self.set_state(current, result)
+
+            # Keep following the object, so that this instance
+            # can be reused for the next transition
+            self.__class__ = result
 
         wrapper.output_states = output_states
+        wrapper.machine = cls.machine
+        wrapper.guards = guards
         return wrapper
 
     def __repr__(cls):
@@ -241,6 +391,16 @@ class StateMeta(ABCMeta):
         """
         return cls.__dict__.get("slug", cls.__name__)
 
+    @property
+    def code(cls):
+        """
+        Optional integer form of the state for compact storage,
+        e.g. in an integer database column. Set it explicitly as a class attribute
+        on every state in the machine (or none of them). Like the slug,
+        it should never change once stored.
+        """
+        return cls.__dict__.get("code")
+
     @property
     def label(cls):
         """
@@ -258,6 +418,10 @@ class StateMeta(ABCMeta):
 
     @property
     def transitions(cls):
+        cached = cls.__dict__.get("_transitions")
+        if cached is not None:
+            return cached
+
         return frozenset().union(*[
             getattr(sub, "direct_transitions", ()) or ()
             for sub in cls.__mro__
@@ -271,56 +435,249 @@ class StateMeta(ABCMeta):
         if not cls.is_state:
             raise AttributeError("This is not a state class")
 
+        cached = cls.__dict__.get("_output_states")
+        if cached is not None:
+            return cached
+
         return frozenset().union(*[
             getattr(func, "output_states", [])
             for func in cls.transitions
         ])
 
-    def check_summary(cls, graph):
+    def can(cls, transition):
         """
-        Checks that the summary graph matches the state classes.
+        Returns True if the transition function is available from this state.
+        """
+        return transition in cls.transitions
+
+    def _peek(cls, obj):
+        """
+        Returns an instance of cls bound to obj without calling __init__,
+        and the current state of obj if it's a state of cls, otherwise None.
+        The state is read with _load_state like in __init__, so e.g. rows are still locked,
+        but inside _fresh_reads, so e.g. not from a cache.
         """
-        missing_classes = []
-        wrong_outputs = []
+        if not cls.is_complete:
+            raise ValueError(
+                f"This machine is not complete, call {cls.machine.__name__}.complete() "
+                f"after declaring all states (subclasses).",
+            )
+
+        instance = cls.__new__(cls)
+        instance.obj = obj
+        with instance._fresh_reads():
+            state = instance._load_state()
+        if not (isinstance(state, StateMeta) and state in cls.machine.states and issubclass(state, cls)):
+            return instance, None
+        instance._state_loaded(state)
+        return instance, state
+
+    def allowed(cls, obj):
+        """
+        Returns the set of transitions available for obj in its current state
+        whose guards it passes, or an empty set if obj isn't in one of the states of this class.
+        Unlike instantiating the class, this never raises an exception for the wrong state.
+        Note that __init__ is not called, but the state is loaded in the same way.
+        """
+        _, state = cls._peek(obj)
+        if state is None:
+            return frozenset()
+
+        transitions = state.transitions
+        if any(transition.guards for transition in transitions):
+            transitions = frozenset(
+                transition
+                for transition in transitions
+                if passes_guards(transition, obj)
+            )
+        return transitions
+
+    def try_transition(cls, obj, transition, *args, **kwargs):
+        """
+        Applies the transition to obj if it's available in the current state of obj
+        and obj passes its guards, passing any additional arguments, and returns the new state.
+        Otherwise returns None instead of raising an exception.
+        Note that __init__ is not called, but the state is loaded in the same way.
+        """
+        instance, state = cls._peek(obj)
+        if state is None or transition not in state.transitions or not passes_guards(transition, obj):
+            return None
+
+        instance.__class__ = state
+        transition(instance, *args, **kwargs)
+        return type(instance)
+
+    def dispatch(cls, obj, name, *args, **kwargs):
+        """
+        Applies the transition with the given name to obj in its current state,
+        passing any additional arguments, and returns the new state.
+        The transition is found with a single lookup in the dispatch_table of the machine.
+        """
+        instance = cls(obj)
+        state = type(instance)
+        machine = cls.machine
+        if state.submachine is not None:
+            target = state._dispatch_target(obj, name)
+            if target is not None and target is not machine:
+                return target.dispatch(obj, name, *args, **kwargs)
+
+        transition = machine.dispatch_table.get((state, name))
+        if transition is None:
+            raise TransitionNotAvailable(
+                "{obj} is in state {state}, which has no transition named {name}. "
+                "The available transitions are: {available}",
+                obj=obj,
+                state=state,
+                name=name,
+                available=sorted(state._available_names(obj)),
+            )
+
+        transition(instance, *args, **kwargs)
+        return type(instance)
+
+    def _dispatch_target(cls, obj, name):
+        """
+        Returns the machine whose transition named name applies to obj in the state cls,
+        looking in the substates (innermost first) before cls itself, or None.
+        """
+        if cls.submachine is not None:
+            _, substate = cls.submachine._peek(obj)
+            if substate is not None:
+                target = substate._dispatch_target(obj, name)
+                if target is not None:
+                    return target
+        if (cls, name) in cls.machine.dispatch_table:
+            return cls.machine
+        return None
+
+    def _available_names(cls, obj):
+        """
+        Returns the names of the transitions that Machine.dispatch
+        could apply to obj in the state cls, including those of its substates.
+        """
+        result = {
+            transition_name
+            for (state, transition_name) in cls.machine.dispatch_table
+            if state is cls
+        }
+        if cls.submachine is not None:
+            _, substate = cls.submachine._peek(obj)
+            if substate is not None:
+                result |= substate._available_names(obj)
+        return result
+
+    def _enter_submachine(cls, obj):
+        """
+        Puts obj in the initial substate of the state cls (recursively), if it has a submachine.
+        """
+        for submachine, initial_substate in cls._entry_chain:
+            instance, substate = submachine._peek(obj)
+            instance.set_state(substate, initial_substate)
+
+    def _exit_submachine(cls, obj):
+        """
+        Puts obj in the final substate of the state cls (recursively), if it has a submachine.
+        """
+        if cls.submachine is None:
+            return
+        instance, substate = cls.submachine._peek(obj)
+        if substate is not None:
+            substate._exit_submachine(obj)
+        instance.set_state(substate, cls.final_substate)
+
+    def diff_summary(cls, graph) -> 'SummaryDiff':
+        """
+        Compares the summary graph with the state classes
+        and returns the differences as a SummaryDiff.
+        """
+        adjacency = cls.adjacency
+        missing_states = {}
+        wrong_outputs = {}
         for state_name, annotation in graph.__annotations__.items():
             output_names = extract_state_names(annotation)
             assert output_names is not None
-            state = cls.name_to_state.get(state_name)
-            if state:
-                actual_output_names = {
-                    out.__name__
-                    for out in state.output_states
-                }
-                if set(output_names) != actual_output_names:
-                    wrong_outputs.append((state, output_names, actual_output_names))
-            else:
-                missing_classes.append((state_name, output_names))
+            actual_output_names = adjacency.get(state_name)
+            if actual_output_names is None:
+                missing_states[state_name] = output_names
+                continue
 
-        if not (missing_classes or wrong_outputs):
+            output_names = frozenset(output_names)
+            if output_names != actual_output_names:
+                wrong_outputs[state_name] = (output_names, actual_output_names)
+
+        return SummaryDiff(missing_states, wrong_outputs)
+
+    def check_summary(cls, graph):
+        """
+        Checks that the summary graph matches the state classes.
+        """
+        diff = cls.diff_summary(graph)
+        if not diff:
             return
 
-        message = "\n"
+        message = ["\n"]
 
-        if missing_classes:
-            message += "Missing states:"
-            for state_name, output_names in missing_classes:
-                message += f"\n\nclass {state_name}({cls.__name__}):"
+        if diff.missing_states:
+            message.append("Missing states:")
+            for state_name, output_names in diff.missing_states.items():
+                message.append(f"\n\nclass {state_name}({cls.__name__}):")
                 if output_names:
                     for output in output_names:
-                        message += f"""
+                        message.append(f"""
     def to_{snake(output)}(self) -> [{output}]:
-        pass\n"""
+        pass\n""")
                 else:
-                    message += "\n    pass\n\n\n"
+                    message.append("\n    pass\n\n\n")
+
+        if diff.wrong_outputs:
+            message.append("Wrong outputs:\n\n")
+            for state_name, (output_names, actual_output_names) in diff.wrong_outputs.items():
+                message.append(
+                    f"Outputs of {state_name}:\n"
+                    f"According to summary       : {', '.join(sorted(output_names))}\n"
+                    f"According to actual classes: {', '.join(sorted(actual_output_names))}\n\n"
+                )
 
-        if wrong_outputs:
-            message += "Wrong outputs:\n\n"
-            for state, output_names, actual_output_names in wrong_outputs:
-                message += f"Outputs of {state.__name__}:\n"
-                message += f"According to summary       : {', '.join(sorted(output_names))}\n"
-                message += f"According to actual classes: {', '.join(sorted(actual_output_names))}\n\n"
+        raise IncorrectSummary("".join(message), diff=diff)
 
-        raise IncorrectSummary(message)
+
+class SummaryDiff(NamedTuple):
+    """
+    Differences between a summary and the actual state classes, from StateMeta.diff_summary.
+
+    missing_states maps the names of states in the summary which don't exist
+    to their declared output names.
+
+    wrong_outputs maps the names of states whose outputs don't match to a pair
+    of sets of output names: (according to the summary, according to the classes).
+    """
+    missing_states: Dict[str, List[str]]
+    wrong_outputs: Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]]
+
+    def __bool__(self):
+        return bool(self.missing_states or self.wrong_outputs)
+
+    @property
+    def missing_edges(self):
+        """
+        Set of (state name, output name) in the summary but not in the classes.
+        """
+        return {
+            (state_name, output)
+            for state_name, (output_names, actual_output_names) in self.wrong_outputs.items()
+            for output in output_names - actual_output_names
+        }
+
+    @property
+    def extra_edges(self):
+        """
+        Set of (state name, output name) in the classes but not in the summary.
+        """
+        return {
+            (state_name, output)
+            for state_name, (output_names, actual_output_names) in self.wrong_outputs.items()
+            for output in actual_output_names - output_names
+        }
 
 
 class BaseState(metaclass=StateMeta):
@@ -328,8 +685,35 @@ class BaseState(metaclass=StateMeta):
     Abstract base class of all states.
     To make state machines you will need a concrete implementation
     with get_state and set_state, usually AttributeState.
+
+    An instance is bound to the object passed to it and follows its state through
+    transitions, so one instance can be reused for several transitions in a row.
+    To save memory, declare __slots__ = () on the machine. Then all classes
+    in the machine get empty __slots__ and their instances don't have a __dict__,
+    so mixins must declare __slots__ too and you can't set other attributes on instances.
+
+    A state can declare a timeout, as a number of seconds or a timedelta,
+    and on_timeout, the name of one of its transitions to apply when an object
+    has been in the state for that long. See friendly_states.timers.
+
+    A state can contain another machine, declared as submachine (the root of
+    a complete machine which stores its state separately on the same object)
+    and initial_substate. Transitioning into the state puts the object in
+    initial_substate, and transitioning out of it sets the substate to
+    final_substate, which is None by default. Machine.dispatch tries
+    the transitions of the substate before those of the state itself.
+    DjangoState saves the state and the substates in one transaction,
+    so a substate which changed elsewhere rejects the whole transition.
     """
 
+    __slots__ = ("obj",)
+    timeout = None
+    on_timeout = None
+    submachine = None
+    initial_substate = None
+    final_substate = None
+    _entry_chain = ()
+
     def __init__(self, obj):
         if not type(self).is_complete:
             raise ValueError(
@@ -338,13 +722,63 @@ class BaseState(metaclass=StateMeta):
             )
 
         self.obj = obj
-        self.__class__ = self._get_and_check_state(
+        state = self._check_state(
+            self._load_state(),
             IncorrectInitialState,
             "{obj} should be in state {desired} but is actually in state {state}"
         )
+        self._state_loaded(state)
+        self.__class__ = state
+
+    def _load_state(self):
+        """
+        Returns the current state of obj when binding this instance to it.
+        By default this is get_state(). Backends can override this together with
+        _state_loaded, e.g. to lock obj and read its state from the database.
+        """
+        return self.get_state()
+
+    def _state_loaded(self, state):
+        """
+        Called with the state returned by _load_state once it has been checked.
+        """
+
+    def _write_together(self):
+        """
+        Returns a context manager around storing a transition together with
+        entering and leaving submachines. Backends can override this to make
+        all the changes in one write, so that they're stored or rejected together.
+        """
+        return nullcontext()
+
+    def _fresh_reads(self):
+        """
+        Returns a context manager around reading the state right before checking a transition
+        (and in _peek), which must see the current state in the backend.
+        Backends that keep copies of states, like CachedState, read the backend inside it.
+        """
+        return nullcontext()
+
+    def _saving_deferred(self) -> bool:
+        """
+        Returns True while the backend defers storing new states, e.g. in a bulk transition,
+        so that set_state returning doesn't mean that the state has been stored yet.
+        """
+        return False
+
+    @classmethod
+    def _stored(cls, obj, state):
+        """
+        Called by backends on the machine after storing deferred changes,
+        with the state now stored for obj, or None if it's unknown because the write failed.
+        """
 
     def _get_and_check_state(self, exception_class, message_format):
-        state = self.get_state()
+        with self._fresh_reads():
+            state = self.get_state()
+        return self._check_state(state, exception_class, message_format)
+
+    def _check_state(self, state, exception_class, message_format):
         if not (isinstance(state, type) and issubclass(state, BaseState)):
             raise GetStateDidNotReturnState(
                 f"get_state is supposed to return a subclass of {BaseState.__name__}, "
@@ -381,15 +815,26 @@ class AttributeState(BaseState):
 
     By default the attribute is named 'state', this can be overridden with the
     attr_name attribute on this class.
+
+    If changed_at_attr_name is set, every transition also stores the time
+    it happened (from current_time) in that attribute of the object,
+    so you can tell how long it has been in its current state.
     """
 
+    __slots__ = ()
     attr_name = "state"
+    changed_at_attr_name = None
 
     def get_state(self):
         return getattr(self.obj, self.attr_name)
 
     def set_state(self, previous_state, new_state):
         setattr(self.obj, self.attr_name, new_state)
+        if self.changed_at_attr_name is not None:
+            setattr(self.obj, self.changed_at_attr_name, self.current_time())
+
+    def current_time(self):
+        return datetime.now(timezone.utc)
 
 
 class MappingKeyState(BaseState):
@@ -400,6 +845,7 @@ class MappingKeyState(BaseState):
     By default the mapping key is the string 'state', this can be overridden with the
     key_name attribute on this class.
     """
+    __slots__ = ()
     key_name = "state"
 
     def get_state(self):
@@ -409,6 +855,86 @@ class MappingKeyState(BaseState):
         self.obj[self.key_name] = new_state
 
 
+class BulkTransitionResult(NamedTuple):
+    succeeded: List[Any]
+    errors: List[Tuple[Any, Exception]]
+
+
+def apply_transitions(pairs, *args, **kwargs) -> BulkTransitionResult:
+    """
+    Takes an iterable of (obj, transition) pairs and applies each transition to its object,
+    passing any additional arguments.
+    Errors are collected per object instead of being raised.
+    Storage backends call this while deferring the saving of the new states.
+    """
+    succeeded = []
+    errors = []
+    for obj, transition in pairs:
+        try:
+            _, state = transition.machine._peek(obj)
+            if state is None or transition not in state.transitions:
+                raise TransitionNotAvailable(
+                    "{obj} is in state {state}, which doesn't have the transition {transition}",
+                    obj=obj,
+                    state=state,
+                    transition=transition,
+                )
+            transition(state(obj), *args, **kwargs)
+        except Exception as e:
+            errors.append((obj, e))
+        else:
+            succeeded.append(obj)
+    return BulkTransitionResult(succeeded, errors)
+
+
+class Guard(NamedTuple):
+    """
+    A condition declared on a transition with the guard decorator.
+    """
+    predicate: Callable[[Any], bool]
+    q: Any = None
+
+    def __repr__(self):
+        return getattr(self.predicate, "__name__", repr(self.predicate))
+
+
+def guard(predicate, q=None):
+    """
+    Decorator for transition methods which declares that predicate(obj) must be true
+    for the transition to happen. Guards are checked before the body of the transition,
+    raising GuardFailed if one returns false.
+
+    q is an optional Django Q object equivalent to the predicate,
+    which allows StateQuerySet to evaluate the guard in the database.
+    """
+
+    def decorator(func):
+        func.guards = [Guard(predicate, q)] + getattr(func, "guards", [])
+        return func
+
+    return decorator
+
+
+def passes_guards(transition, obj):
+    """
+    Returns True if obj passes all the guards of the transition.
+    Doesn't check the state of obj.
+    """
+    return all(g.predicate(obj) for g in transition.guards)
+
+
+def check_guards(transition, objs):
+    """
+    Returns a list of booleans saying whether each object passes all the guards
+    of the transition, without running it. Doesn't check the states of the objects.
+    """
+    predicates = [g.predicate for g in transition.guards]
+    return [
+        all(predicate(obj) for predicate in predicates)
+        for obj in objs
+    ]
+
+
 def extract_state_names(annotation):
     if not isinstance(annotation, str):
         raise ValueError(
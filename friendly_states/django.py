@@ -41,34 +41,348 @@ Similarly you mustn't delete a state class if you stop using it as long as your
 `max_length` is automatically set to the maximum length of all the slugs in the machine. If you want to save space in your database, override the slugs to something shorter.
 
 `choices` is constructed from the `slug` and `label` of every state. To customise how states are displayed in forms etc, override the `label` attribute on the class.
+
+To work with the machine metadata in the database, use `StateQuerySet` as the manager of your model:
+
+```python
+class MyModel(models.Model):
+    state = StateField(MyMachine)
+    objects = StateQuerySet.as_manager()
+```
+
+Then `MyModel.objects.with_transitions()` annotates every object with `state_transitions`, the names of the transitions available from its current state, and `with_output_states()` annotates `state_output_states`, the states it can reach directly. Both are computed by the database with a `CASE` over the state column, so a whole page of objects needs just one query.
+
+To transition many objects at once, use `bulk_transition` with pairs of objects and transitions:
+
+```python
+result = MyModel.objects.bulk_transition([(obj1, MyState.do_thing), (obj2, OtherState.do_other_thing)])
+```
+
+Each transition is checked against the machine and run as usual, but instead of saving each object the new states are written in a single `UPDATE` which only changes rows that are still in the state they were loaded with. Errors are not raised but collected per object in `result.errors` as `(obj, exception)` pairs, while `result.succeeded` lists the objects that were transitioned and saved. Note that only the state field (and its timestamp, see below) is saved.
+
+If the guards of a transition (see `friendly_states.core.guard`) are declared with `q`, `MyModel.objects.filter_transition(MyState.do_thing)` returns only the objects that are in a state with that transition and pass its guards, so the guards become part of the `WHERE` clause. `claim` applies these guards too.
+
+For heavily contended rows, set `select_for_update = True` on your machine. Then instantiating a state first fetches the row again with `SELECT ... FOR UPDATE` and copies the state from the database to the object, so the transition runs under a row lock until the transaction commits. The state is only copied to the object if it's the state being instantiated. This must happen inside a transaction, which `locked` provides:
+
+```python
+with MyState.locked(obj) as state:
+    state.do_thing()
+```
+
+Set `nowait = True` to raise an error immediately if the row is already locked instead of waiting, or `skip_locked = True` to make `locked` yield `None` so that you can move on to other rows. `lock_timeout` can be set to a maximum number of seconds to wait for the lock, currently only on PostgreSQL. Rows are not locked one by one while saving is deferred, i.e. in `bulk_transition`, `claim`, `fire_timeouts`, `BatchCommitter` and `unit_of_work`, since the conditional `UPDATE` already checks that each row is still in its previous state.
+
+To use a machine as a job queue, `claim` picks up objects in a state and transitions them in one transaction:
+
+```python
+result = Pending.claim(MyModel.objects.order_by("id"), limit=100, transition=Pending.start)
+for obj in result.succeeded:
+    ...
+```
+
+Rows locked by other workers are skipped with `SELECT ... FOR UPDATE SKIP LOCKED`. On databases without `SKIP LOCKED` such as SQLite, the conditional `UPDATE` of `bulk_transition` still ensures that an object is only claimed by one worker.
+
+To record when each object entered its current state, pass `track_changed_at=True`:
+
+```python
+state = StateField(MyMachine, track_changed_at=True)
+```
+
+This adds a nullable `DateTimeField` named `state_changed_at` (after the name of the state field) to the model. The timestamp is set when an object is first saved and whenever it transitions, in the same `UPDATE` as the state. The generated field appears in your migrations like any other. To make queries such as "objects which have been in this state for more than a day" a single index range scan, declare an index on both columns yourself:
+
+```python
+class Meta:
+    indexes = [models.Index(fields=["state", "state_changed_at"])]
+```
+
+In async code, where many coroutines transition different objects at the same time, a `BatchCommitter` saves their changes together instead of running one query per transition:
+
+```python
+committer = BatchCommitter(delay=0.005, max_size=100)
+
+new_state = await committer.transition(obj, MyState.do_thing)
+```
+
+The transition runs immediately in memory, then the change waits in a queue which is saved in a single conditional `UPDATE` after `delay` seconds or as soon as it holds `max_size` changes. Each coroutine gets its own result: `StateChangedElsewhere` is raised (and the state of the object is restored) only for the rows which were changed elsewhere in the meantime. Call `await committer.flush()` before shutting down.
+
+Similarly, to transition many objects in one request without a query for each, use a unit of work:
+
+```python
+with MyMachine.unit_of_work():
+    for obj in objs:
+        MyState(obj).do_thing()
+```
+
+Inside the block, transitions only change the objects in memory. At the end of the block, all the changes are saved in a transaction with one conditional `UPDATE` per state field. If any of the rows has been changed elsewhere, or the block raises an exception, nothing is saved and the states of the objects are restored. `bulk_transition` inside the block becomes part of the unit of work, so its changes are also saved at the end. `claim` and `fire_timeouts` still save immediately in their own transaction, which holds the locks on the rows they select. Machines with `auto_save = False` are left alone: their transitions change the objects in memory as usual and nothing is saved for them.
+
+If a transition also changes other fields, e.g. `self.obj.paid_at = timezone.now()`, those fields are saved in the same transaction with `obj.save(update_fields=[...])`, one query for each object which has such changes. Only the fields which differ from when the object was first transitioned (or instantiated as a state) in the block are saved.
+
+States can declare a `timeout` and an `on_timeout` transition (see `friendly_states.timers`). If your model has a datetime field recording when the state last changed, `MyModel.objects.fire_timeouts("state_changed_at")` applies the `on_timeout` transitions to all the objects that have been in such a state for too long, in the same way as `claim`. With `track_changed_at=True` the field name can be left out.
 """
+import asyncio
+import sys
+from collections import defaultdict
+from copy import deepcopy
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import reduce
+from operator import or_
+from datetime import timedelta
 from warnings import warn
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, router, transaction, connections
+from django.db.models import Case, Value, When, Q, F
+from django.db.models.lookups import Exact
+from django.utils import timezone
+
+from friendly_states.core import StateMeta, AttributeState, BulkTransitionResult, apply_transitions
+from friendly_states.exceptions import DjangoStateAttrNameWarning, StateChangedElsewhere, RowLocked
+
+# While this is set to a list, DjangoState.set_state appends
+# (obj, previous_state, new_state) to it instead of saving
+_pending_changes: ContextVar = ContextVar("_pending_changes", default=None)
+
+
+class _UnitOfWork(list):
+    """
+    The changes deferred by DjangoState.unit_of_work, which unlike other deferred changes
+    leave out machines with auto_save = False, since they wouldn't be saved otherwise.
+    Also remembers the other fields of the transitioned objects,
+    so that the ones which transitions change can be saved as well.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # id(obj) -> (obj, values of its other fields when it was first seen)
+        self.originals = {}
+
+    def track(self, obj):
+        if id(obj) not in self.originals:
+            self.originals[id(obj)] = (obj, _other_field_values(obj))
+
+    def save_other_fields(self, using):
+        for obj, original in self.originals.values():
+            changed = [
+                attname
+                for attname, value in _other_field_values(obj).items()
+                if attname not in original or original[attname] != value
+            ]
+            if changed:
+                obj.save(using=using, update_fields=changed)
+
 
-from friendly_states.core import StateMeta, AttributeState
-from friendly_states.exceptions import DjangoStateAttrNameWarning
+def _other_field_values(obj):
+    """
+    Returns copies of the values of the loaded concrete fields of obj
+    other than its primary key, state fields and their timestamps.
+    """
+    excluded = {obj._meta.pk.attname}
+    for field in obj._meta.concrete_fields:
+        if isinstance(field, StateField):
+            excluded.add(field.attname)
+            if field.changed_at_field:
+                excluded.add(field.changed_at_field.attname)
+    return {
+        field.attname: deepcopy(obj.__dict__[field.attname])
+        for field in obj._meta.concrete_fields
+        if field.attname in obj.__dict__ and field.attname not in excluded
+    }
 
 
 class DjangoState(AttributeState):
     __doc__ = globals()["__doc__"]
 
+    __slots__ = ()
     attr_name = None
     auto_save = True
+    select_for_update = False
+    nowait = False
+    skip_locked = False
+    lock_timeout = None
+
+    def _locks_row(self):
+        # Deferred changes are checked by a conditional UPDATE instead,
+        # and rows from claim and fire_timeouts are already locked
+        return self.select_for_update and _pending_changes.get() is None
+
+    def _load_state(self):
+        if self._locks_row():
+            return self._lock_row(self.obj)
+        return super()._load_state()
+
+    def _state_loaded(self, state):
+        if self._locks_row():
+            setattr(self.obj, self.attr_name, state)
+        self._track()
+
+    def _track(self):
+        # Remember the other fields before a transition changes them
+        pending = _pending_changes.get()
+        if isinstance(pending, _UnitOfWork) and self.auto_save:
+            pending.track(self.obj)
+
+    def _lock_row(self, obj):
+        """
+        Fetches the row of obj again with SELECT ... FOR UPDATE
+        and returns the state in the database.
+        The state is only copied to obj once it has been checked.
+        """
+        model = type(obj)
+        using = router.db_for_write(model, instance=obj)
+        connection = connections[using]
+        if self.lock_timeout is not None and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT set_config('lock_timeout', %s, true)",
+                    [f"{int(self.lock_timeout * 1000)}ms"],
+                )
+
+        rows = list(
+            model._default_manager
+                .using(using)
+                .select_for_update(nowait=self.nowait, skip_locked=self.skip_locked)
+                .filter(pk=obj.pk)
+                .values_list(self.attr_name, flat=True)
+        )
+        if not rows:
+            if self.skip_locked:
+                raise RowLocked(
+                    "The row of {obj} is locked by another transaction (or doesn't exist)",
+                    obj=obj,
+                )
+            raise model.DoesNotExist(f"{obj} no longer exists in the database")
+
+        return rows[0]
+
+    @classmethod
+    @contextmanager
+    def locked(cls, obj):
+        """
+        Opens a transaction and yields cls(obj) inside it,
+        so with select_for_update the row stays locked until the end of the block.
+        Yields None if skip_locked is set and the row is locked elsewhere.
+        """
+        with transaction.atomic(using=router.db_for_write(type(obj), instance=obj)):
+            try:
+                state = cls(obj)
+            except RowLocked:
+                state = None
+            yield state
+
+    @classmethod
+    def claim(cls, queryset, limit, transition, *args, **kwargs) -> 'BulkTransitionResult':
+        """
+        Selects up to limit objects from queryset which are in this state
+        (or a subclass if this is abstract) and pass the guards of transition which have q,
+        skipping rows locked by other transactions,
+        and applies transition to all of them with bulk_transition in a single transaction.
+        """
+        queryset = queryset.all()
+        states = [state for state in cls.machine.states if issubclass(state, cls)]
+        with transaction.atomic(using=queryset.db):
+            candidates = queryset.filter(
+                transition_q(transition, require_q=False),
+                **{f"{cls.attr_name}__in": states}
+            )
+            if connections[queryset.db].features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+
+            pairs = [(obj, transition) for obj in candidates[:limit]]
+            with _saving_immediately():
+                return bulk_transition(queryset, pairs, *args, **kwargs)
+
+    @classmethod
+    @contextmanager
+    def unit_of_work(cls, using=None):
+        """
+        Defers saving the states of all objects transitioned inside the block
+        (for any machine based on DjangoState) until the end of the block,
+        when they're saved with one conditional UPDATE per state field in a transaction.
+        If any row is no longer in the state it was in before the block,
+        nothing is saved, the objects are restored in memory, and StateChangedElsewhere is raised.
+        If the block raises an exception, nothing is saved and the objects are restored in memory.
+        A nested unit of work or bulk_transition is part of the outer one,
+        while claim and fire_timeouts save immediately in their own transaction.
+        Other fields changed by transitions are saved with save(update_fields=...)
+        for each object, and machines with auto_save = False are not saved at all.
+        """
+        if _pending_changes.get() is not None:
+            yield
+            return
+
+        changes = _UnitOfWork()
+        token = _pending_changes.set(changes)
+        try:
+            yield
+        except BaseException:
+            _revert_changes(changes)
+            raise
+        finally:
+            _pending_changes.reset(token)
+
+        if not changes:
+            return
+
+        try:
+            with transaction.atomic(using=using):
+                failed = _save_changes(changes, using)
+                if failed:
+                    # Roll back the changes that were saved
+                    change = next(change for change in changes if _change_key(change) in failed)
+                    raise StateChangedElsewhere(
+                        "The state of {obj} in the database is no longer {state}",
+                        obj=change[0],
+                        state=failed[_change_key(change)],
+                    )
+                changes.save_other_fields(using)
+        except BaseException:
+            _revert_changes(changes)
+            raise
+
+    def _saving_deferred(self):
+        return _pending_changes.get() is not None
+
+    @contextmanager
+    def _write_together(self):
+        if _pending_changes.get() is not None:
+            # Already deferred, e.g. in bulk_transition
+            yield
+            return
+
+        # Check and save the state and the substates together,
+        # then save the rest of the object as usual
+        using = router.db_for_write(type(self.obj), instance=self.obj)
+        with transaction.atomic(using=using):
+            with self.unit_of_work(using=using):
+                yield
+            if self.auto_save:
+                self.obj.save()
 
     def set_state(self, previous_state, new_state):
+        pending = _pending_changes.get()
+        if pending is not None and (self.auto_save or not isinstance(pending, _UnitOfWork)):
+            # In case this instance was created before the unit of work
+            self._track()
+            # The timestamp is set when the pending changes are saved
+            setattr(self.obj, self.attr_name, new_state)
+            pending.append((self.obj, previous_state, new_state))
+            return
+
         super().set_state(previous_state, new_state)
         if self.auto_save:
             self.obj.save()
 
+    def current_time(self):
+        return timezone.now()
+
 
 class StateField(models.CharField):
     __doc__ = globals()["__doc__"]
 
     empty_strings_allowed = False
 
-    def __init__(self, machine, *args, **kwargs):
+    def __init__(self, machine, *args, track_changed_at=False, **kwargs):
         if not (isinstance(machine, StateMeta) and machine.is_machine):
             raise ValueError(f"{machine} is not a state machine root")
 
@@ -88,6 +402,15 @@ class StateField(models.CharField):
                 )
 
         self.machine = machine
+        self.track_changed_at = track_changed_at
+        self.changed_at_field = None
+
+        # Precomputed mappings for fast conversions in both directions
+        self._states = {sys.intern(slug): state for slug, state in machine.slug_to_state.items()}
+        self._states[None] = None
+        self._slugs = {state: sys.intern(state.slug) for state in machine.states}
+        self._slugs.update((slug, slug) for slug in self._states)
+
         kwargs["max_length"] = max(map(len, machine.slug_to_state))
         kwargs.setdefault("verbose_name", machine.label)
         kwargs["choices"] = [
@@ -112,6 +435,8 @@ class StateField(models.CharField):
         del kwargs["choices"]
         if kwargs["verbose_name"] == self.machine.label:
             del kwargs["verbose_name"]
+        if self.track_changed_at:
+            kwargs["track_changed_at"] = True
 
         return name, path, (self.machine,), kwargs
 
@@ -137,9 +462,35 @@ class StateField(models.CharField):
         else:
             machine.attr_name = self.attname
 
+        # Fields of abstract models are copied to their subclasses,
+        # and the copy of this field adds the timestamp there.
+        # Historical models built by migrations already have the timestamp
+        # from their own AddField operation.
+        if (
+                self.track_changed_at
+                and not cls._meta.abstract
+                and cls.__module__ != "__fake__"
+        ):
+            self._add_changed_at_field(cls, name)
+
+    def _add_changed_at_field(self, cls, name):
+        changed_at_field = models.DateTimeField(null=True, blank=True, editable=False)
+        changed_at_name = f"{name}_changed_at"
+        cls.add_to_class(changed_at_name, changed_at_field)
+        self.changed_at_field = changed_at_field
+        self.machine.changed_at_attr_name = changed_at_field.attname
+
+    def pre_save(self, model_instance, add):
+        changed_at_field = self.changed_at_field
+        if add and changed_at_field and getattr(model_instance, changed_at_field.attname) is None:
+            setattr(model_instance, changed_at_field.attname, timezone.now())
+        return super().pre_save(model_instance, add)
+
     # noinspection PyUnusedLocal
     def from_db_value(self, value, expression, connection):
-        return self.to_python(value)
+        # Values from the database are always slugs or None,
+        # so skip the checks in to_python
+        return self._states[value]
 
     def to_python(self, value):
         if value is None:
@@ -151,30 +502,534 @@ class StateField(models.CharField):
         return self.machine.slug_to_state[value]
 
     def get_prep_value(self, value):
+        try:
+            return self._slugs[value]
+        except (KeyError, TypeError):
+            pass
+
+        # Only build the error messages when there is actually an error
         machine = self.machine
         if isinstance(value, StateMeta):
-            if value not in machine.states:
-                raise ValidationError(
-                    f"{value} is a state class but isn't one of the states "
-                    f"in the machine {machine.__name__}, which are "
-                    f"{sorted(machine.states)}",
-                )
-            return value.slug
+            raise ValidationError(
+                f"{value} is a state class but isn't one of the states "
+                f"in the machine {machine.__name__}, which are "
+                f"{sorted(machine.states)}",
+            )
         elif isinstance(value, str):
-            if value not in machine.slug_to_state:
-                raise ValidationError(
-                    f"{value} is not one of the valid slugs for this machine: "
-                    f"{sorted(state.slug for state in machine.states)}",
-                )
-        elif value is not None:
+            raise ValidationError(
+                f"{value} is not one of the valid slugs for this machine: "
+                f"{sorted(state.slug for state in machine.states)}",
+            )
+        else:
             raise ValidationError(
                 f"{self.name} should be a state class, a string, or None, not {value}",
             )
 
-        return value
+    def to_states(self, slugs):
+        """
+        Converts an iterable of slugs (or None) from the database to a list of states,
+        e.g. for the results of values_list.
+        """
+        return list(map(self._states.__getitem__, slugs))
+
+    def to_slugs(self, values):
+        """
+        Converts an iterable of states, slugs, or None to a list of validated slugs,
+        e.g. to prepare values for bulk_create or bulk_update.
+        """
+        # The values may be a one-shot iterator and the fallback needs a second pass
+        values = list(values)
+        get_prep_value = self.get_prep_value
+        slugs = self._slugs
+        try:
+            return list(map(slugs.__getitem__, values))
+        except (KeyError, TypeError):
+            # Find the first invalid value and raise a helpful error
+            return [get_prep_value(value) for value in values]
 
     def get_db_prep_value(self, value, connection, prepared=False):
         return self.get_prep_value(value)
 
     def value_to_string(self, obj):
         return self.get_prep_value(obj)
+
+    def _case(self, values, output_field):
+        """
+        Returns a CASE expression over this column which evaluates to
+        values[state] for each state, stored as a comma separated string.
+        """
+        return Case(
+            *[
+                When(**{self.name: state.slug}, then=Value(",".join(sorted(values[state]))))
+                for state in sorted(self.machine.states)
+            ],
+            default=None,
+            output_field=output_field,
+        )
+
+    def transitions_case(self):
+        """
+        CASE expression evaluating to the names of the transitions
+        available from the state in each row.
+        """
+        return self._case({
+            state: [transition.__name__ for transition in state.transitions]
+            for state in self.machine.states
+        }, _NameSetField())
+
+    def output_states_case(self):
+        """
+        CASE expression evaluating to the states which can be reached directly
+        from the state in each row.
+        """
+        return self._case({
+            state: [output.__name__ for output in state.output_states]
+            for state in self.machine.states
+        }, _NameSetField(self.machine))
+
+
+class _NameSetField(models.CharField):
+    """
+    Output field for the expressions built by StateField._case.
+    Converts the comma separated names back into a frozenset of strings,
+    or of states if a machine is given.
+    """
+
+    def __init__(self, machine=None):
+        self.machine = machine
+        super().__init__()
+
+    # noinspection PyUnusedLocal
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+
+        names = value.split(",") if value else ()
+        if self.machine:
+            return frozenset(self.machine.name_to_state[name] for name in names)
+        return frozenset(names)
+
+
+def transition_q(transition, require_q=True):
+    """
+    Returns a Q object matching rows in a state which has the transition
+    and which pass its guards.
+    Guards without q raise a ValueError, or are ignored if require_q is false.
+    """
+    machine = transition.machine
+    states = [state for state in machine.states if state.can(transition)]
+    result = Q(**{f"{machine.attr_name}__in": states})
+    for g in transition.guards:
+        if g.q is None:
+            if require_q:
+                raise ValueError(
+                    f"The guard {g} of the transition {transition.__name__} "
+                    f"has no Q object to filter with."
+                )
+        else:
+            result &= g.q
+    return result
+
+
+def bulk_transition(queryset, pairs, *args, **kwargs) -> BulkTransitionResult:
+    """
+    Applies each transition to its object, then saves the new states of the objects
+    in the database of queryset with one conditional UPDATE per state field.
+    Transitions of objects of other models, e.g. in the bodies of transitions, are saved too.
+    See StateQuerySet.bulk_transition.
+    """
+    if _pending_changes.get() is not None:
+        # Inside e.g. a unit of work, which saves and checks the changes at the end
+        return apply_transitions(pairs, *args, **kwargs)
+
+    changes = []
+    token = _pending_changes.set(changes)
+    try:
+        succeeded, errors = apply_transitions(pairs, *args, **kwargs)
+    finally:
+        _pending_changes.reset(token)
+
+    try:
+        failed = _save_changes(changes, queryset.db)
+    except BaseException:
+        # Nothing was saved
+        _revert_changes(changes)
+        raise
+
+    if failed:
+        failed_objs = set()
+        for change in changes:
+            obj = change[0]
+            key = _change_key(change)
+            if key not in failed:
+                continue
+            original_state = failed.pop(key)
+            setattr(obj, key[1], original_state)
+            failed_objs.add(id(obj))
+            errors.append((obj, StateChangedElsewhere(
+                "The state of {obj} in the database is no longer {state}",
+                obj=obj,
+                state=original_state,
+            )))
+        succeeded = [obj for obj in succeeded if id(obj) not in failed_objs]
+    return BulkTransitionResult(succeeded, errors)
+
+
+def _group_changes(model, changes):
+    """
+    Groups a list of (obj, previous_state, new_state) by the StateField they belong to,
+    merging multiple changes of the same object into one.
+    Changes which cancel out (e.g. A -> B -> A) are kept, so that the conditional UPDATE
+    still checks that the row hasn't changed elsewhere while the transitions ran.
+    """
+    result = defaultdict(dict)
+    for obj, previous_state, new_state in changes:
+        # The previous state is None when first entering a submachine
+        field = model._meta.get_field((previous_state or new_state).machine.attr_name)
+        field_changes = result[field]
+        key = id(obj)
+        if key in field_changes:
+            previous_state = field_changes[key][1]
+        field_changes[key] = (obj, previous_state, new_state)
+
+    return {
+        field: list(field_changes.values())
+        for field, field_changes in result.items()
+    }
+
+
+def _conditional_update(queryset, field, changes):
+    """
+    Saves the new states of the objects in changes, a list of (obj, previous_state, new_state),
+    in a single UPDATE which only matches rows still in their previous state.
+    Returns the changes that couldn't be saved because the row changed elsewhere.
+    A row which is already in its new state counts as saved.
+    """
+    if not changes:
+        return []
+
+    by_previous = defaultdict(list)
+    by_new = defaultdict(list)
+    for obj, previous_state, new_state in changes:
+        by_previous[previous_state].append(obj.pk)
+        by_new[new_state].append(obj.pk)
+
+    condition = reduce(or_, [
+        Q(**{field.name: previous_state, "pk__in": pks})
+        for previous_state, pks in by_previous.items()
+    ])
+
+    if len(by_new) == 1:
+        (new_value,) = by_new
+    else:
+        new_value = Case(
+            *[
+                When(pk__in=pks, then=Value(new_state, output_field=field))
+                for new_state, pks in by_new.items()
+            ],
+            output_field=field,
+        )
+
+    values = {field.name: new_value}
+    changed_at_field = field.changed_at_field
+    if changed_at_field:
+        now = timezone.now()
+        values[changed_at_field.name] = now
+
+    updated = queryset.filter(condition).update(**values)
+    if updated == len(changes):
+        failed = []
+    else:
+        # Some rows didn't match, find out which
+        actual = dict(
+            queryset
+                .filter(pk__in=[obj.pk for obj, _, _ in changes])
+                .values_list("pk", field.name)
+        )
+        failed = [
+            change
+            for change in changes
+            if actual.get(change[0].pk) is not change[2]
+        ]
+
+    if changed_at_field:
+        failed_objs = {id(obj) for obj, _, _ in failed}
+        for obj, _, _ in changes:
+            if id(obj) not in failed_objs:
+                setattr(obj, changed_at_field.attname, now)
+
+    return failed
+
+
+def _save_changes(changes, using=None):
+    """
+    Saves changes, a list of (obj, previous_state, new_state) of any models,
+    with one conditional UPDATE per state field, and returns a dict mapping
+    (id(obj), attr_name) to the original state of each field that couldn't be saved.
+    Several UPDATEs run in a transaction, so that if one raises, nothing is saved.
+    """
+    by_model = defaultdict(list)
+    for change in changes:
+        by_model[type(change[0])].append(change)
+
+    updates = [
+        (model._default_manager.db_manager(using).all(), field, field_changes)
+        for model, model_changes in by_model.items()
+        for field, field_changes in _group_changes(model, model_changes).items()
+    ]
+
+    failed = {}
+    # A single UPDATE is atomic by itself
+    with transaction.atomic(using=using) if len(updates) > 1 else nullcontext():
+        for queryset, field, field_changes in updates:
+            for obj, previous_state, _ in _conditional_update(queryset, field, field_changes):
+                failed[id(obj), field.attname] = previous_state
+    return failed
+
+
+@contextmanager
+def _saving_immediately():
+    """
+    Saves changes inside the block immediately, even inside a unit of work.
+    """
+    token = _pending_changes.set(None)
+    try:
+        yield
+    finally:
+        _pending_changes.reset(token)
+
+
+def _change_key(change):
+    obj, previous_state, new_state = change
+    return id(obj), (previous_state or new_state).machine.attr_name
+
+
+def _revert_changes(changes):
+    """
+    Restores the states of the objects in changes in memory
+    to what they were before the first change.
+    """
+    for obj, previous_state, new_state in reversed(changes):
+        setattr(obj, (previous_state or new_state).machine.attr_name, previous_state)
+
+
+class BatchCommitter:
+    """
+    Saves the transitions of many coroutines together.
+    Each change is queued, and the queue is flushed with one conditional UPDATE per state field
+    after delay seconds or as soon as it holds max_size changes, whichever comes first.
+    Use one committer per event loop.
+
+    run_sync is used to call the synchronous database code from the event loop,
+    by default asgiref's sync_to_async.
+    """
+
+    def __init__(self, delay=0.005, max_size=100, using=None, run_sync=None):
+        self.delay = delay
+        self.max_size = max_size
+        self.using = using
+        self.run_sync = run_sync or (lambda func: sync_to_async(func)())
+        self._queue = []
+        self._timer = None
+        self._flushes = set()
+
+    async def transition(self, obj, transition, *args, **kwargs):
+        """
+        Applies transition to obj in memory, passing any additional arguments,
+        and waits until the new state has been saved with the next batch.
+        Returns the new state. If the row in the database is no longer in the previous state,
+        the state of obj is restored and StateChangedElsewhere is raised.
+        """
+        changes = []
+        token = _pending_changes.set(changes)
+        try:
+            _, errors = apply_transitions([(obj, transition)], *args, **kwargs)
+        finally:
+            _pending_changes.reset(token)
+        if errors:
+            raise errors[0][1]
+
+        await asyncio.gather(*map(self._enqueue, changes))
+        return getattr(obj, transition.machine.attr_name)
+
+    async def flush(self):
+        """
+        Saves the queued changes now and waits until all batches have been saved.
+        """
+        self._start_flush()
+        while self._flushes:
+            await asyncio.gather(*self._flushes)
+
+    def _enqueue(self, change):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((change, future))
+        if len(self._queue) >= self.max_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, self._start_flush)
+        return future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        changes = [change for change, _ in batch]
+
+        def save():
+            with transaction.atomic(using=self.using):
+                return _save_changes(changes, self.using)
+
+        try:
+            failed = await self.run_sync(save)
+        except Exception as e:
+            # The transaction was rolled back, restore every field to its state before the batch
+            failed = {}
+            for change in changes:
+                failed.setdefault(_change_key(change), change[1])
+            error = e
+        else:
+            error = None
+
+        for change, future in batch:
+            key = _change_key(change)
+            obj, _, new_state = change
+            if key in failed:
+                original_state = failed[key]
+                setattr(obj, key[1], original_state)
+
+            if future.cancelled():
+                continue
+            if key not in failed:
+                future.set_result(new_state)
+                continue
+
+            future.set_exception(error or StateChangedElsewhere(
+                "The state of {obj} in the database is no longer {state}",
+                obj=obj,
+                state=original_state,
+            ))
+
+
+def regions_q(field_name, *states):
+    """
+    Returns a Q object matching rows where the integer field field_name,
+    which stores the combined value of some Regions (see friendly_states.regions),
+    contains all the given states.
+    If a state of every region is given, this is a simple equality.
+    """
+    if not states:
+        return Q()
+    regions = states[0].regions
+    mask, bits = regions.pattern(*states)
+    if mask == (1 << regions.bits) - 1:
+        return Q(**{field_name: bits})
+    return Q(Exact(F(field_name).bitand(mask), bits))
+
+
+class StateQuerySet(models.QuerySet):
+    __doc__ = globals()["__doc__"]
+
+    def _state_field(self, field_name) -> StateField:
+        field = self.model._meta.get_field(field_name)
+        if not isinstance(field, StateField):
+            raise TypeError(f"{field_name} is not a StateField")
+        return field
+
+    def with_transitions(self, field_name="state", annotation_name=None):
+        """
+        Annotates each object with a frozenset of the names of the transitions
+        available from its current state, by default as <field_name>_transitions.
+        """
+        field = self._state_field(field_name)
+        return self.annotate(**{
+            annotation_name or f"{field_name}_transitions": field.transitions_case()
+        })
+
+    def with_output_states(self, field_name="state", annotation_name=None):
+        """
+        Annotates each object with a frozenset of the states that can be reached
+        directly from its current state, by default as <field_name>_output_states.
+        """
+        field = self._state_field(field_name)
+        return self.annotate(**{
+            annotation_name or f"{field_name}_output_states": field.output_states_case()
+        })
+
+    def filter_transition(self, transition):
+        """
+        Filters to objects in a state which has the transition and which pass its guards.
+        All the guards must have been declared with q.
+        """
+        return self.filter(transition_q(transition))
+
+    def _changed_at_field_name(self, field, changed_at_field):
+        if changed_at_field is not None:
+            return changed_at_field
+        if field.changed_at_field is None:
+            raise TypeError(
+                f"{field.name} was not declared with track_changed_at=True, "
+                f"so changed_at_field must be given"
+            )
+        return field.changed_at_field.name
+
+    def timed_out(self, changed_at_field=None, field_name="state", now=None):
+        """
+        Filters to objects which have been in a state with a timeout for at least that long,
+        according to the datetime field changed_at_field,
+        which defaults to the timestamp added by track_changed_at.
+        """
+        field = self._state_field(field_name)
+        changed_at_field = self._changed_at_field_name(field, changed_at_field)
+        if now is None:
+            now = timezone.now()
+
+        conditions = [
+            Q(**{
+                field.name: state,
+                f"{changed_at_field}__lte": now - timedelta(seconds=timeout),
+            })
+            for state, (timeout, _) in field.machine.timeouts.items()
+        ]
+        if not conditions:
+            return self.none()
+        return self.filter(reduce(or_, conditions))
+
+    def fire_timeouts(self, changed_at_field=None, field_name="state", now=None, limit=None) -> BulkTransitionResult:
+        """
+        Applies the on_timeout transitions to up to limit timed out objects (see timed_out)
+        with bulk_transition, skipping rows locked by other transactions.
+        """
+        field = self._state_field(field_name)
+        timeouts = field.machine.timeouts
+        with transaction.atomic(using=self.db):
+            candidates = self.timed_out(changed_at_field, field_name, now)
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            if limit is not None:
+                candidates = candidates[:limit]
+
+            pairs = [
+                (obj, timeouts[getattr(obj, field.attname)][1])
+                for obj in candidates
+            ]
+            with _saving_immediately():
+                return bulk_transition(self, pairs)
+
+    def bulk_transition(self, pairs, *args, **kwargs) -> BulkTransitionResult:
+        """
+        Takes an iterable of (obj, transition) pairs, where transition is e.g. MyState.do_thing.
+        Any additional arguments are passed to every transition.
+        Validates and runs the transitions in memory,
+        then saves the new states with a single conditional UPDATE.
+        Errors are collected per object instead of being raised.
+        """
+        return bulk_transition(self, pairs, *args, **kwargs)
@@ -1,11 +1,25 @@
 class StateMachineException(Exception):
+    """
+    The message is only formatted when it's first needed,
+    so raising and catching these exceptions is cheap.
+    The keyword arguments are available as attributes.
+    """
+
     def __init__(self, message_format, **kwargs):
-        if kwargs:
-            self.message = message_format.format(**kwargs)
-        else:
-            self.message = message_format
+        self.message_format = message_format
+        self._format_kwargs = kwargs
+        self._message = None
         self.__dict__.update(**kwargs)
 
+    @property
+    def message(self):
+        if self._message is None:
+            if self._format_kwargs:
+                self._message = self.message_format.format(**self._format_kwargs)
+            else:
+                self._message = self.message_format
+        return self._message
+
     def __str__(self):
         return self.message
 
@@ -38,6 +52,10 @@ class DuplicateStateNames(StateMachineException):
     pass
 
 
+class DuplicateStateCodes(StateMachineException):
+    pass
+
+
 class DuplicateOutputStates(StateMachineException):
     pass
 
@@ -54,5 +72,17 @@ class GetStateDidNotReturnState(StateMachineException):
     pass
 
 
+class TransitionNotAvailable(StateMachineException):
+    pass
+
+
+class RowLocked(StateMachineException):
+    pass
+
+
+class GuardFailed(StateMachineException):
+    pass
+
+
 class DjangoStateAttrNameWarning(Warning):
     pass
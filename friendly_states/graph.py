@@ -0,0 +1,154 @@
+"""
+Export the transition graph of a machine as DOT (Graphviz), GraphML, Mermaid or JSON,
+without any dependencies.
+
+Each edge is labelled with the name of the transition. The output is sorted,
+so it's stable and can be diffed, e.g. to review changes to a machine in CI.
+
+From the command line, with any machine that can be imported:
+
+    python -m friendly_states.graph mypackage.mymodule:MyMachine --format dot
+
+or in Python:
+
+    from friendly_states.graph import to_dot
+    print(to_dot(MyMachine))
+"""
+import argparse
+import importlib
+import json
+import sys
+from typing import List, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+
+def edges(machine) -> List[Tuple[str, str, str]]:
+    """
+    Returns a sorted list of (source state, transition, output state) names
+    for all the transitions in the complete machine.
+    """
+    if not machine.is_complete:
+        raise ValueError(
+            f"This machine is not complete, call {machine.__name__}.complete() "
+            f"after declaring all states (subclasses).",
+        )
+    return sorted(
+        (state.__name__, name, output_state.__name__)
+        for (state, name), transition in machine.dispatch_table.items()
+        for output_state in transition.output_states
+    )
+
+
+def _state_names(machine):
+    return sorted(state.__name__ for state in machine.states)
+
+
+def _quote(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def to_dot(machine) -> str:
+    lines = [f"digraph {_quote(machine.__name__)} {{"]
+    for name in _state_names(machine):
+        lines.append(f"    {_quote(name)};")
+    for source, transition, target in edges(machine):
+        lines.append(f"    {_quote(source)} -> {_quote(target)} [label={_quote(transition)}];")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def to_mermaid(machine) -> str:
+    lines = ["stateDiagram-v2"]
+    for name in _state_names(machine):
+        lines.append(f"    {name}")
+    for source, transition, target in edges(machine):
+        lines.append(f"    {source} --> {target}: {transition}")
+    return "\n".join(lines) + "\n"
+
+
+def to_graphml(machine) -> str:
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">',
+        '  <key id="transition" for="edge" attr.name="transition" attr.type="string"/>',
+        f'  <graph id={quoteattr(machine.__name__)} edgedefault="directed">',
+    ]
+    for name in _state_names(machine):
+        lines.append(f"    <node id={quoteattr(name)}/>")
+    for source, transition, target in edges(machine):
+        lines += [
+            f"    <edge source={quoteattr(source)} target={quoteattr(target)}>",
+            f'      <data key="transition">{escape(transition)}</data>',
+            "    </edge>",
+        ]
+    lines += ["  </graph>", "</graphml>"]
+    return "\n".join(lines) + "\n"
+
+
+def to_json(machine) -> str:
+    states = []
+    for state in sorted(machine.states):
+        info = {"name": state.__name__, "slug": state.slug, "label": state.label}
+        if state.code is not None:
+            info["code"] = state.code
+        states.append(info)
+
+    return json.dumps(
+        {
+            "machine": machine.__name__,
+            "states": states,
+            "edges": [
+                {"source": source, "transition": transition, "target": target}
+                for source, transition, target in edges(machine)
+            ],
+        },
+        indent=2,
+    ) + "\n"
+
+
+FORMATS = {
+    "dot": to_dot,
+    "graphml": to_graphml,
+    "mermaid": to_mermaid,
+    "json": to_json,
+}
+
+
+def import_machine(path):
+    """
+    Imports a machine from a string like 'package.module:Machine'.
+    """
+    module_name, _, attr = path.partition(":")
+    if not attr:
+        raise ValueError(f"Expected 'module:Machine', got {path!r}")
+    result = importlib.import_module(module_name)
+    for part in attr.split("."):
+        result = getattr(result, part)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m friendly_states.graph",
+        description="Export the transition graph of a state machine.",
+    )
+    parser.add_argument("machine", help="The machine to export, as module:Machine")
+    parser.add_argument("--format", "-f", choices=sorted(FORMATS), default="dot")
+    parser.add_argument("--output", "-o", help="Write to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # Allow importing modules from the current directory, as python -m does
+    if "" not in sys.path:
+        sys.path.insert(0, "")
+
+    machine = import_machine(args.machine)
+    output = FORMATS[args.format](machine)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == "__main__":
+    main()
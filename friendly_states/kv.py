@@ -0,0 +1,309 @@
+"""
+To keep states in a key-value store such as Redis, make your machine inherit from `KeyValueState` and give it a client:
+
+```python
+from friendly_states.kv import KeyValueState, RedisClient
+
+
+class MyMachine(KeyValueState):
+    is_machine = True
+    client = RedisClient(redis.Redis())
+    key_prefix = "my_machine:"
+```
+
+The state of an object is stored as its slug under the key `key_prefix + str(obj)`, override the `get_key` classmethod to change this. Objects don't need any attributes, e.g. they can simply be IDs. To give an object its initial state, use `MyState.initialize(obj)`.
+
+Instantiating a state reads the key, and a transition writes it with an atomic compare-and-set, so if another process has changed the state in the meantime, `StateChangedElsewhere` is raised and nothing is written.
+
+`bulk_transition(pairs)` takes an iterable of `(obj, transition)` pairs and applies them all with only two round trips per client: one to read all the states and one pipeline of compare-and-sets. As in the database backends, errors are collected per object in the returned `BulkTransitionResult`.
+
+Clients implement the small interface of `KeyValueClient`. `RedisClient` wraps a `redis.Redis` client and does the compare-and-set in a Lua script. `InMemoryClient` keeps everything in a dict, for tests and single process use.
+"""
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Optional, List, Tuple, Iterable
+
+from friendly_states.core import BaseState, BulkTransitionResult, apply_transitions
+from friendly_states.exceptions import StateChangedElsewhere, IncorrectInitialState
+
+
+class KeyValueClient(ABC):
+    """
+    The operations that KeyValueState needs from a store.
+    Values are strings, and None means that the key is missing,
+    so setting a key to None deletes it.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def compare_and_set(self, key: str, expected: Optional[str], value: Optional[str]) -> bool:
+        """
+        Atomically sets key to value if its current value is expected
+        and returns whether it did.
+        """
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Returns the values of keys in order.
+        Override this to fetch them in one round trip.
+        """
+        return [self.get(key) for key in keys]
+
+    def compare_and_set_many(self, items: Iterable[Tuple[str, Optional[str], Optional[str]]]) -> List[bool]:
+        """
+        Calls compare_and_set for each (key, expected, value) in items and returns the results.
+        Each compare-and-set is atomic, but not the whole batch.
+        Override this to send them in one round trip.
+        """
+        return [self.compare_and_set(*item) for item in items]
+
+
+class InMemoryClient(KeyValueClient):
+    """
+    Keeps the values in a dict, safe to share between threads.
+    round_trips counts the calls, as if each was a request to a server.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        self.round_trips += 1
+        return [self.data.get(key) for key in keys]
+
+    def compare_and_set(self, key, expected, value):
+        self.round_trips += 1
+        with self._lock:
+            return self._compare_and_set(key, expected, value)
+
+    def compare_and_set_many(self, items):
+        self.round_trips += 1
+        with self._lock:
+            return [self._compare_and_set(*item) for item in items]
+
+    def _compare_and_set(self, key, expected, value):
+        if self.data.get(key) != expected:
+            return False
+        if value is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = value
+        return True
+
+
+_CAS_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if ARGV[3] == '1' then
+    if current then
+        return 0
+    end
+elseif current ~= ARGV[1] then
+    return 0
+end
+if ARGV[4] == '1' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+class RedisClient(KeyValueClient):
+    """
+    Wraps a client from the redis package.
+    Compare-and-set runs as a Lua script, and the batch operations use MGET and a pipeline.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._cas = redis.register_script(_CAS_SCRIPT)
+
+    def get(self, key):
+        return _decode(self.redis.get(key))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [_decode(value) for value in self.redis.mget(keys)]
+
+    def compare_and_set(self, key, expected, value):
+        return bool(self._cas(keys=[key], args=_cas_args(expected, value)))
+
+    def compare_and_set_many(self, items):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, expected, value in items:
+            self._cas(keys=[key], args=_cas_args(expected, value), client=pipeline)
+        return [bool(result) for result in pipeline.execute()]
+
+
+def _cas_args(expected, value):
+    return [
+        expected or "",
+        value or "",
+        "1" if expected is None else "0",
+        "1" if value is None else "0",
+    ]
+
+
+def _slug(state):
+    return None if state is None else state.slug
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+class _Batch:
+    """
+    The states read and written by bulk_transition.
+    While set, KeyValueState uses it instead of the client.
+    """
+
+    def __init__(self):
+        # key -> current state (or raw value, if it's not a state)
+        self.states = {}
+
+        # key -> (client, value before the batch), for the keys that were changed
+        self.original = {}
+
+
+_batch: ContextVar = ContextVar("_batch", default=None)
+
+
+class KeyValueState(BaseState):
+    __doc__ = globals()["__doc__"]
+
+    __slots__ = ()
+    client: KeyValueClient = None
+    key_prefix = "state:"
+
+    @classmethod
+    def get_key(cls, obj) -> str:
+        return f"{cls.key_prefix}{obj}"
+
+    @classmethod
+    def initialize(cls, obj):
+        """
+        Stores this state as the state of obj, which mustn't have a state yet,
+        otherwise IncorrectInitialState is raised.
+        """
+        if not cls.is_state:
+            raise ValueError(f"{cls} is not a concrete state of a complete machine")
+        if not cls.client.compare_and_set(cls.get_key(obj), None, cls.slug):
+            raise IncorrectInitialState("{obj} already has a state", obj=obj)
+
+    def _saving_deferred(self):
+        return _batch.get() is not None
+
+    def get_state(self):
+        key = self.get_key(self.obj)
+        batch = _batch.get()
+        if batch is not None and key in batch.states:
+            return batch.states[key]
+        return self._to_state(self.client.get(key))
+
+    def set_state(self, previous_state, new_state):
+        key = self.get_key(self.obj)
+        batch = _batch.get()
+        if batch is not None:
+            batch.original.setdefault(key, (self.client, _slug(previous_state)))
+            batch.states[key] = new_state
+            return
+
+        if not self.client.compare_and_set(key, _slug(previous_state), _slug(new_state)):
+            raise StateChangedElsewhere(
+                "The state of {obj} in the store is no longer {state}",
+                obj=self.obj,
+                state=previous_state,
+            )
+
+    @classmethod
+    def _to_state(cls, value):
+        # Unknown values are returned as is so that the error shows them
+        return cls.machine.slug_to_state.get(value, value)
+
+
+def bulk_transition(pairs, *args, **kwargs) -> BulkTransitionResult:
+    """
+    Takes an iterable of (obj, transition) pairs, where transition is e.g. MyState.do_thing,
+    for machines which inherit from KeyValueState.
+    Any additional arguments are passed to every transition.
+    Reads the states of all the objects with one get_many per client,
+    runs the transitions in memory, then writes the new states with one compare_and_set_many per client.
+    Errors are collected per object instead of being raised,
+    including StateChangedElsewhere when the state was changed by someone else in between.
+    """
+    batch = _Batch()
+
+    keys_by_client = defaultdict(dict)
+    key_objects = {}
+    valid_pairs = []
+    errors = []
+    for obj, transition in pairs:
+        try:
+            machine = transition.machine
+            key = machine.get_key(obj)
+        except Exception as e:
+            errors.append((obj, e))
+            continue
+        keys_by_client[machine.client][key] = machine
+        key_objects[key] = obj
+        valid_pairs.append((obj, transition))
+    for client, key_machines in keys_by_client.items():
+        keys = list(key_machines)
+        for key, value in zip(keys, client.get_many(keys)):
+            batch.states[key] = key_machines[key]._to_state(value)
+
+    token = _batch.set(batch)
+    try:
+        succeeded, transition_errors = apply_transitions(valid_pairs, *args, **kwargs)
+    finally:
+        _batch.reset(token)
+    errors += transition_errors
+
+    writes_by_client = defaultdict(list)
+    for key, (client, original) in batch.original.items():
+        writes_by_client[client].append((key, original, _slug(batch.states[key])))
+
+    failed_keys = {}
+    try:
+        for client, writes in writes_by_client.items():
+            for (key, original, _), ok in zip(writes, client.compare_and_set_many(writes)):
+                machine = keys_by_client[client][key]
+                if ok:
+                    machine._stored(key_objects[key], batch.states[key])
+                else:
+                    failed_keys[key] = machine._to_state(original)
+                    machine._stored(key_objects[key], None)
+    except BaseException:
+        # Some of the writes may have happened
+        for key, (client, _) in batch.original.items():
+            keys_by_client[client][key]._stored(key_objects[key], None)
+        raise
+
+    if failed_keys:
+        failed = set()
+        for key, state in failed_keys.items():
+            obj = key_objects[key]
+            failed.add(id(obj))
+            errors.append((obj, StateChangedElsewhere(
+                "The state of {obj} in the store is no longer {state}",
+                obj=obj,
+                state=state,
+            )))
+        succeeded = [obj for obj in succeeded if id(obj) not in failed]
+    return BulkTransitionResult(succeeded, errors)
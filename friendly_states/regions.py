@@ -0,0 +1,144 @@
+"""
+Orthogonal regions: several independent machines whose states are stored together in one integer.
+
+Each machine must inherit from `RegionState` and give all its states integer codes. Declare the regions once the machines are complete:
+
+```python
+class PaymentMachine(RegionState):
+    is_machine = True
+
+...  # declare states with codes
+
+PaymentMachine.complete()
+FulfilmentMachine.complete()
+
+order_regions = Regions(PaymentMachine, FulfilmentMachine, attr_name="regions")
+```
+
+Each machine gets a fixed range of bits, just wide enough for its largest code, in the order they are given. `order_regions.encode(Unpaid, NotShipped)` returns the combined integer, which you store in the attribute `attr_name` of your objects, e.g. an indexed integer column. A new object must be given such a value with a state for every region before any transitions. Then each machine works like any other, e.g. `Unpaid(order).pay()`, reading and replacing only its own bits.
+
+Transitions only change the attribute in memory, like `AttributeState`: nothing is saved, so you must persist the value yourself, e.g. with `order.save()` for Django. There is no compare-and-set either, so unlike the database and key-value backends, nothing raises `StateChangedElsewhere` if the value was changed elsewhere in the meantime, and saving the whole integer overwrites the other regions. Use a transaction with row locks (e.g. `select_for_update`) if several processes change the same object.
+
+To check several regions at once, `order_regions.matches(order.regions, Paid, Shipped)` does a single comparison of the masked bits. For the database, `friendly_states.django.regions_q("regions", Paid, Shipped)` filters in the same way, and if a state of every region is given it's a plain equality which can use an index.
+"""
+from typing import Tuple
+
+from friendly_states.core import BaseState, StateMeta
+
+
+class Regions:
+    """
+    The regions formed by machines, stored together in the attribute attr_name of objects.
+    """
+
+    def __init__(self, *machines, attr_name="regions"):
+        if not machines:
+            raise ValueError("Regions need at least one machine")
+
+        self.machines = machines
+        self.attr_name = attr_name
+
+        # machine -> (shift, mask)
+        self.layout = {}
+        shift = 0
+        for machine in machines:
+            if not (isinstance(machine, StateMeta) and machine.is_machine and issubclass(machine, RegionState)):
+                raise ValueError(f"{machine} is not the root of a machine based on RegionState")
+            if not machine.is_complete:
+                raise ValueError(
+                    f"This machine is not complete, call {machine.__name__}.complete() "
+                    f"after declaring all states (subclasses).",
+                )
+            if not machine.code_to_state:
+                raise ValueError(f"The states of {machine} don't have codes")
+            if machine in self.layout or machine.regions is not None:
+                raise ValueError(f"{machine} is already in a region")
+
+            bits = max(max(machine.code_to_state).bit_length(), 1)
+            self.layout[machine] = (shift, ((1 << bits) - 1) << shift)
+            shift += bits
+
+        self.bits = shift
+        for machine in machines:
+            machine.regions = self
+
+    def encode(self, *states) -> int:
+        """
+        Returns the combined value of states, one state from each region.
+        """
+        mask, value = self.pattern(*states)
+        if len(states) != len(self.machines):
+            raise ValueError(f"Expected one state from each of {self.machines}, got {states}")
+        return value
+
+    def decode(self, value) -> Tuple:
+        """
+        Returns the states in value, in the order of the regions.
+        """
+        return tuple(self.get(value, machine) for machine in self.machines)
+
+    def get(self, value, machine):
+        """
+        Returns the state of the region machine in value,
+        or None if value is None or the code isn't valid.
+        """
+        if value is None:
+            return None
+        shift, mask = self.layout[machine]
+        return machine.code_to_state.get((value & mask) >> shift)
+
+    def replace(self, value, state) -> int:
+        """
+        Returns value with the region of state replaced by state.
+        value can't be None, since the other regions would then need states too.
+        """
+        shift, mask = self.layout[self._machine(state)]
+        if value is None:
+            raise ValueError(
+                f"Can't set {state} without the states of the other regions, "
+                f"give the object a value from encode() first"
+            )
+        return (value & ~mask) | (state.code << shift)
+
+    def pattern(self, *states) -> Tuple[int, int]:
+        """
+        Returns (mask, bits) such that value & mask == bits
+        if and only if value contains all the given states, at most one per region.
+        """
+        mask = bits = 0
+        for state in states:
+            shift, region_mask = self.layout[self._machine(state)]
+            if mask & region_mask:
+                raise ValueError(f"More than one state was given for the region of {state}")
+            mask |= region_mask
+            bits |= state.code << shift
+        return mask, bits
+
+    def matches(self, value, *states) -> bool:
+        """
+        Returns whether value contains all the given states.
+        """
+        mask, bits = self.pattern(*states)
+        return value is not None and value & mask == bits
+
+    def _machine(self, state):
+        machine = getattr(state, "machine", None)
+        if machine not in self.layout or state not in machine.states:
+            raise ValueError(f"{state} is not a state of one of the regions {self.machines}")
+        return machine
+
+
+class RegionState(BaseState):
+    __doc__ = globals()["__doc__"]
+
+    __slots__ = ()
+    regions: Regions = None
+
+    def get_state(self):
+        value = getattr(self.obj, self.regions.attr_name)
+        return self.regions.get(value, self.machine)
+
+    def set_state(self, previous_state, new_state):
+        regions = self.regions
+        value = getattr(self.obj, regions.attr_name)
+        setattr(self.obj, regions.attr_name, regions.replace(value, new_state))
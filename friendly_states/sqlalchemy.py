@@ -0,0 +1,312 @@
+"""
+To store states in a database with SQLAlchemy, declare a column with `StateType` and make your machine inherit from `SQLAlchemyState`:
+
+```python
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from friendly_states.sqlalchemy import SQLAlchemyState, StateType
+
+
+class MyMachine(SQLAlchemyState):
+    is_machine = True
+
+...  # declare states
+
+MyMachine.complete()
+
+
+class MyModel(Base):
+    __tablename__ = "my_model"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    state = mapped_column(StateType(MyMachine), nullable=False)
+```
+
+The column stores the slugs of the states, or their integer `code`s with `StateType(MyMachine, use_codes=True)`. Either way the mapped attribute holds the state classes, and you can compare the column to them in queries, e.g. `select(MyModel).where(MyModel.state == MyState)`.
+
+The attribute must be named by `attr_name` on the machine, which is `"state"` by default. When an object which is already in the database (and in a session) transitions, the new state is written immediately with a compare-and-swap:
+
+```sql
+UPDATE my_model SET state = :new WHERE id = :id AND state = :previous
+```
+
+If no row matches because the state was changed elsewhere in the meantime, `StateChangedElsewhere` is raised and the object is left unchanged. Objects which haven't been flushed yet are simply changed in memory. If the machine has a `changed_at_attr_name`, that column is set in the same `UPDATE`. The session's transaction is not committed.
+
+To transition many objects at once, use `bulk_transition(session, pairs)` with an iterable of `(obj, transition)` pairs. The transitions run in memory and the new states are written with one conditional `UPDATE` per table, like `StateQuerySet.bulk_transition` in `friendly_states.django`. `transition_selected(session, select(MyModel).where(...), MyState.do_thing)` runs a `select()` statement, restricted to objects in a state with that transition, and applies the transition to all of them in the same way.
+"""
+from collections import defaultdict
+from contextvars import ContextVar
+
+from sqlalchemy import Integer, String, TypeDecorator, and_, case, inspect, literal, or_, select, update
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from friendly_states.core import StateMeta, AttributeState, BulkTransitionResult, apply_transitions
+from friendly_states.exceptions import StateChangedElsewhere
+
+# While this is set to a list, SQLAlchemyState.set_state appends
+# (obj, previous_state, new_state, changed_at) to it instead of updating the row
+_pending_changes: ContextVar = ContextVar("_pending_changes", default=None)
+
+
+class StateType(TypeDecorator):
+    """
+    Column type which stores the states of machine as slugs,
+    or as integer codes if use_codes is true.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, machine, use_codes=False):
+        if not (isinstance(machine, StateMeta) and machine.is_machine):
+            raise ValueError(f"{machine} is not a state machine root")
+
+        if not machine.is_complete:
+            raise ValueError(
+                f"This machine is not complete, call {machine.__name__}.complete() "
+                f"after declaring all states (subclasses).",
+            )
+
+        self.machine = machine
+        self.use_codes = use_codes
+
+        if use_codes:
+            if not machine.code_to_state:
+                raise ValueError(f"The states of {machine} don't have codes")
+            super().__init__()
+            self.impl = Integer()
+            self._states = dict(machine.code_to_state)
+            self._values = {state: state.code for state in machine.states}
+        else:
+            super().__init__(length=max(map(len, machine.slug_to_state)))
+            self._states = dict(machine.slug_to_state)
+            self._values = {state: state.slug for state in machine.states}
+
+        self._states[None] = None
+        self._values.update((value, value) for value in self._states)
+
+    # noinspection PyUnusedLocal
+    def process_bind_param(self, value, dialect):
+        try:
+            return self._values[value]
+        except (KeyError, TypeError):
+            raise ValueError(f"{value!r} is not a state of {self.machine}") from None
+
+    # noinspection PyUnusedLocal
+    def process_result_value(self, value, dialect):
+        return self._states[value]
+
+
+class SQLAlchemyState(AttributeState):
+    __doc__ = globals()["__doc__"]
+
+    __slots__ = ()
+
+    def _saving_deferred(self):
+        return _pending_changes.get() is not None
+
+    def set_state(self, previous_state, new_state):
+        obj = self.obj
+        if inspect(obj).identity is None or object_session(obj) is None:
+            super().set_state(previous_state, new_state)
+            return
+
+        changed_at = None
+        if self.changed_at_attr_name is not None:
+            changed_at = self.current_time()
+
+        pending = _pending_changes.get()
+        if pending is not None:
+            pending.append((obj, previous_state, new_state, changed_at))
+            # bulk_transition sets the timestamp once the UPDATE has succeeded
+            changed_at = None
+        else:
+            _conditional_update(object_session(obj), [(obj, previous_state, new_state, changed_at)], raise_error=True)
+
+        _set_committed_state(obj, self.machine, new_state, changed_at)
+
+
+def _set_committed_state(obj, machine, state, changed_at=None):
+    """
+    Sets the state of obj in memory without marking it as modified,
+    as the database has been (or will be) updated already.
+    """
+    set_committed_value(obj, machine.attr_name, state)
+    if changed_at is not None:
+        set_committed_value(obj, machine.changed_at_attr_name, changed_at)
+
+
+def transition_clause(entity, transition, require_q=True):
+    """
+    Returns a clause for the mapped class entity matching rows in a state
+    which has the transition and which pass its guards.
+    The q of each guard should be a clause, or a function which takes entity and returns one.
+    Guards without q raise a ValueError, or are ignored if require_q is false.
+    """
+    machine = transition.machine
+    states = [state for state in machine.states if state.can(transition)]
+    clauses = [getattr(entity, machine.attr_name).in_(states)]
+    for g in transition.guards:
+        if g.q is None:
+            if require_q:
+                raise ValueError(
+                    f"The guard {g} of the transition {transition.__name__} "
+                    f"has no clause to filter with."
+                )
+        else:
+            clauses.append(g.q(entity) if callable(g.q) else g.q)
+    return and_(*clauses)
+
+
+def bulk_transition(session, pairs, *args, **kwargs) -> BulkTransitionResult:
+    """
+    Takes an iterable of (obj, transition) pairs, where transition is e.g. MyState.do_thing.
+    Any additional arguments are passed to every transition.
+    Validates and runs the transitions in memory,
+    then saves the new states with one conditional UPDATE per table and machine.
+    Errors are collected per object instead of being raised,
+    including StateChangedElsewhere for rows whose state changed in the database.
+    Bulk updates require a single column primary key.
+    """
+    changes = []
+    token = _pending_changes.set(changes)
+    try:
+        succeeded, errors = apply_transitions(pairs, *args, **kwargs)
+    finally:
+        _pending_changes.reset(token)
+
+    # Merge multiple changes of the same object and group them by table and machine
+    merged = {}
+    for obj, previous_state, new_state, changed_at in changes:
+        if id(obj) in merged:
+            previous_state = merged[id(obj)][1]
+        merged[id(obj)] = (obj, previous_state, new_state, changed_at)
+
+    groups = defaultdict(list)
+    for change in merged.values():
+        groups[type(change[0]), change[2].machine].append(change)
+
+    failed = set()
+    for group_changes in groups.values():
+        for obj, previous_state, _, _ in _conditional_update(session, group_changes):
+            set_committed_value(obj, previous_state.machine.attr_name, previous_state)
+            failed.add(id(obj))
+            errors.append((obj, StateChangedElsewhere(
+                "The state of {obj} in the database is no longer {state}",
+                obj=obj,
+                state=previous_state,
+            )))
+
+    for obj, _, new_state, changed_at in merged.values():
+        if id(obj) not in failed:
+            _set_committed_state(obj, new_state.machine, new_state, changed_at)
+
+    if failed:
+        succeeded = [obj for obj in succeeded if id(obj) not in failed]
+    return BulkTransitionResult(succeeded, errors)
+
+
+def transition_selected(session, statement, transition, *args, **kwargs) -> BulkTransitionResult:
+    """
+    Executes statement, a select() of a mapped class,
+    restricted to rows in a state which has transition and pass its guards which have q,
+    and applies transition to all the selected objects with bulk_transition.
+    Rows locked by other transactions are skipped where the database supports it.
+    """
+    entity = statement.column_descriptions[0]["entity"]
+    statement = (
+        statement
+            .where(transition_clause(entity, transition, require_q=False))
+            .with_for_update(skip_locked=True)
+    )
+    pairs = [(obj, transition) for obj in session.scalars(statement)]
+    return bulk_transition(session, pairs, *args, **kwargs)
+
+
+def _conditional_update(session, changes, raise_error=False):
+    """
+    Saves the new states of the objects in changes, a list of
+    (obj, previous_state, new_state, changed_at) of the same class and machine,
+    in a single UPDATE which only matches rows still in their previous state.
+    Returns the changes that couldn't be saved because the row changed elsewhere,
+    or raises StateChangedElsewhere if raise_error is true.
+    A row which is already in its new state counts as saved.
+    """
+    obj, previous_state, new_state, changed_at = changes[0]
+    model = type(obj)
+    machine = new_state.machine
+    column = getattr(model, machine.attr_name)
+    mapper = inspect(model)
+
+    identities = [inspect(change[0]).identity for change in changes]
+
+    if len(changes) == 1:
+        identity_condition = _identity_condition(mapper, identities[0])
+        condition = and_(column == previous_state, identity_condition)
+        new_value = new_state
+    else:
+        if len(mapper.primary_key) != 1:
+            raise ValueError(f"Bulk transitions of {model} require a single column primary key")
+        (pk_column,) = mapper.primary_key
+        identity_condition = pk_column.in_([pk for (pk,) in identities])
+
+        by_previous = defaultdict(list)
+        by_new = defaultdict(list)
+        for (obj, previous_state, new_state, _), (pk,) in zip(changes, identities):
+            by_previous[previous_state].append(pk)
+            by_new[new_state].append(pk)
+
+        condition = or_(*[
+            and_(column == previous_state, pk_column.in_(pks))
+            for previous_state, pks in by_previous.items()
+        ])
+
+        if len(by_new) == 1:
+            (new_value,) = by_new
+        else:
+            new_value = case(
+                *[
+                    (pk_column.in_(pks), literal(new_state, column.type))
+                    for new_state, pks in by_new.items()
+                ],
+            )
+
+    values = {column: new_value}
+    changed_ats = [change[3] for change in changes if change[3] is not None]
+    if changed_ats:
+        values[getattr(model, machine.changed_at_attr_name)] = max(changed_ats)
+
+    result = session.execute(
+        update(model)
+            .where(condition)
+            .values(values)
+            .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == len(changes):
+        return []
+
+    # Some rows didn't match, find out which
+    actual = {
+        tuple(row[:-1]): row[-1]
+        for row in session.execute(select(*mapper.primary_key, column).where(identity_condition))
+    }
+    failed = [
+        change
+        for change, identity in zip(changes, identities)
+        if actual.get(identity) is not change[2]
+    ]
+    if failed and raise_error:
+        obj, previous_state, _, _ = failed[0]
+        raise StateChangedElsewhere(
+            "The state of {obj} in the database is no longer {state}",
+            obj=obj,
+            state=previous_state,
+        )
+    return failed
+
+
+def _identity_condition(mapper, identity):
+    return and_(*[
+        pk_column == value
+        for pk_column, value in zip(mapper.primary_key, identity)
+    ])
@@ -0,0 +1,139 @@
+"""
+Generates large state machines programmatically, for benchmarks and scale tests
+of things like complete() and check_summary.
+
+    generated = generate_machine(1000, fan_out=3, abstract_layers=2)
+    S0 = generated.states[0]
+    S0(obj).t0()
+
+Each state S<i> has fan_out transitions t0, t1, ... By default the outputs are chosen
+deterministically so that t0 goes from S<i> to S<i + 1>, making all states reachable
+from each other. Pass a seed to choose the outputs randomly instead.
+"""
+import random
+from types import SimpleNamespace
+
+from friendly_states.core import AttributeState, StateMeta
+
+
+def generate_machine(
+        n_states,
+        fan_out=1,
+        outputs_per_transition=1,
+        abstract_layers=0,
+        abstract_width=2,
+        base=AttributeState,
+        slots=False,
+        seed=None,
+        name="Machine",
+        complete=True,
+):
+    """
+    Returns a SimpleNamespace with:
+
+    - machine: the root of a new machine with n_states states S0, S1, ...
+    - states: the list of state classes, in order
+    - abstract_states: the list of abstract classes
+    - Summary: a summary class matching the machine, which is also attached
+      to the machine so that complete() checks it
+    - edges: a dict mapping each state name to the set of its output state names
+
+    Each state has fan_out transitions named t0, t1, ... each declaring
+    outputs_per_transition output states.
+
+    abstract_layers adds that many layers of abstract classes between the machine and
+    the states, each layer having abstract_width classes which inherit from the
+    previous layer. Each abstract class has one transition a<layer>_<index>
+    which is inherited by its states.
+
+    base is the concrete BaseState subclass that the machine inherits from.
+    If slots is true, the machine declares empty __slots__.
+    The machine is completed unless complete=False.
+    """
+    if n_states < 1:
+        raise ValueError("n_states must be at least 1")
+    if not 1 <= outputs_per_transition <= n_states:
+        raise ValueError("outputs_per_transition must be between 1 and n_states")
+
+    rng = random.Random(seed)
+    names = [f"S{i}" for i in range(n_states)]
+
+    def outputs(i, k):
+        if seed is None:
+            return [names[(i + k + j + 1) % n_states] for j in range(outputs_per_transition)]
+        return rng.sample(names, outputs_per_transition)
+
+    edges = {state_name: set() for state_name in names}
+    machine_attrs = {"is_machine": True}
+    if slots:
+        machine_attrs["__slots__"] = ()
+    machine = StateMeta(name, (base,), machine_attrs)
+
+    abstract_states = []
+    layer = [machine]
+    layer_outputs = {}
+    for layer_index in range(abstract_layers):
+        new_layer = []
+        for index in range(abstract_width):
+            transition_name = f"a{layer_index}_{index}"
+            output_names = outputs(layer_index * abstract_width + index, 0)
+            parent = layer[index % len(layer)]
+            cls = StateMeta(
+                f"Abstract{layer_index}_{index}",
+                (parent,),
+                {
+                    "is_abstract": True,
+                    transition_name: _make_transition(transition_name, output_names),
+                },
+            )
+            layer_outputs[cls] = set(output_names) | layer_outputs.get(parent, set())
+            new_layer.append(cls)
+        abstract_states += new_layer
+        layer = new_layer
+
+    states = []
+    for i, state_name in enumerate(names):
+        parent = layer[i % len(layer)]
+        attrs = {}
+        for k in range(fan_out):
+            transition_name = f"t{k}"
+            output_names = outputs(i, k)
+            attrs[transition_name] = _make_transition(transition_name, output_names)
+            edges[state_name].update(output_names)
+        edges[state_name].update(layer_outputs.get(parent, ()))
+        states.append(StateMeta(state_name, (parent,), attrs))
+
+    summary = type("Summary", (), {
+        "__annotations__": {
+            state_name: f"[{', '.join(sorted(output_names))}]"
+            for state_name, output_names in edges.items()
+        }
+    })
+    machine.Summary = summary
+
+    if complete:
+        machine.complete()
+
+    return SimpleNamespace(
+        machine=machine,
+        states=states,
+        abstract_states=abstract_states,
+        Summary=summary,
+        edges=edges,
+    )
+
+
+def _make_transition(name, output_names):
+    """
+    Returns a transition function named name with a return annotation declaring output_names.
+    If there are several outputs, the transition returns the first one.
+    """
+    first_output = output_names[0]
+
+    def transition(self):
+        if len(output_names) > 1:
+            return self.machine.name_to_state[first_output]
+
+    transition.__name__ = transition.__qualname__ = name
+    transition.__annotations__ = {"return": f"[{', '.join(output_names)}]"}
+    return transition
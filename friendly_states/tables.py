@@ -0,0 +1,324 @@
+"""
+Tables of state codes indexed by integer IDs, for services that keep the states of many entities on a single host.
+
+Each state in the machine must have an integer `code`. A table stores one fixed-width unsigned integer per ID: the code of the state, or all ones (`table.empty`) for IDs without a state. The width is the smallest of 1, 2, 4 or 8 bytes that fits the codes. Reading a state is then an index into the buffer and a dict lookup, and a transition is a compare-and-swap of one integer in place.
+
+`MmapStateTable` keeps the codes in a memory-mapped file, so the states survive restarts, and other processes can open the same file with `readonly=True` to read them without copying:
+
+```python
+class MyMachine(TableState):
+    is_machine = True
+
+...  # declare states, each with a code
+
+MyMachine.complete()
+MyMachine.table = MmapStateTable("states.bin", MyMachine, size=1_000_000)
+```
+
+The objects are then the integer IDs themselves (override the `get_id` classmethod to use e.g. `obj.id` instead), and `MyState.initialize(obj)` gives an object its first state.
+
+`table.codes` is a memoryview of the raw codes which can be passed to other libraries, and `table.as_array()` returns a NumPy array sharing the same memory, for vectorized reads. Only one process should write to a memory-mapped table, while any number can read it.
+
+For several processes which all make transitions, such as the workers of a server, use `SharedMemoryStateTable` (Python 3.8+). It keeps the codes in a block of `multiprocessing.shared_memory`, and each compare-and-set holds one of a fixed number of locks ("stripes") shared between the processes, chosen by the ID, so transitions of different IDs rarely wait for each other. Create it in the parent process before starting the workers, which then inherit it (with `fork`) or receive it as an argument of `multiprocessing.Process` and attach to the same memory and locks. Reads don't take a lock.
+"""
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+
+from friendly_states.core import BaseState
+from friendly_states.exceptions import StateChangedElsewhere, IncorrectInitialState
+
+# Struct formats of the supported widths of codes, in bytes
+_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def code_width(machine) -> int:
+    """
+    Returns the number of bytes needed to store the codes of machine,
+    keeping the largest value free to mean 'no state'.
+    """
+    if not machine.code_to_state:
+        raise ValueError(f"The states of {machine} don't have codes")
+    largest = max(machine.code_to_state)
+    for width in _FORMATS:
+        if largest < 2 ** (8 * width) - 1:
+            return width
+    raise ValueError(f"The code {largest} is too large")
+
+
+class StateTable:
+    """
+    Base class of tables of state codes for machine, stored in buffer.
+    Subclasses provide the buffer.
+    """
+
+    def __init__(self, machine, buffer, readonly=False):
+        if not machine.is_complete:
+            raise ValueError(
+                f"This machine is not complete, call {machine.__name__}.complete() "
+                f"after declaring all states (subclasses).",
+            )
+
+        self.machine = machine
+        self.width = code_width(machine)
+        self.empty = 2 ** (8 * self.width) - 1
+        self.readonly = readonly
+        self._buffer = memoryview(buffer)
+        self.codes = self._buffer.cast(_FORMATS[self.width])
+        self._states = dict(machine.code_to_state)
+        self._states[self.empty] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, id):
+        """
+        Returns the state of id, or None if it doesn't have one.
+        """
+        self._check_id(id)
+        return self._states[self.codes[id]]
+
+    def set(self, id, state):
+        """
+        Sets the state of id unconditionally, or clears it if state is None.
+        """
+        self._check_id(id)
+        self.codes[id] = self._code(state)
+
+    def compare_and_set(self, id, expected, state) -> bool:
+        """
+        Atomically sets the state of id to state if it's currently expected
+        (None meaning no state) and returns whether it did.
+        """
+        self._check_id(id)
+        expected = self._code(expected)
+        state = self._code(state)
+        with self._lock_for(id):
+            if self.codes[id] != expected:
+                return False
+            self.codes[id] = state
+            return True
+
+    def _check_id(self, id):
+        # Negative indices would silently refer to IDs from the end of the table
+        if not 0 <= id < len(self.codes):
+            raise IndexError(f"{id} is not an ID of this table, which has room for 0 to {len(self.codes) - 1}")
+
+    # noinspection PyUnusedLocal
+    def _lock_for(self, id):
+        return self._lock
+
+    def _code(self, state):
+        if state is None:
+            return self.empty
+        if state not in self.machine.states:
+            raise ValueError(f"{state} is not a state of {self.machine}")
+        return state.code
+
+    def as_array(self):
+        """
+        Returns a NumPy array of the codes which shares memory with the table.
+        Requires numpy to be installed.
+        """
+        import numpy
+
+        return numpy.frombuffer(self.codes, dtype=f"u{self.width}")
+
+    def release(self):
+        """
+        Releases the views of the buffer, after which the table can't be used.
+        """
+        self.codes.release()
+        self._buffer.release()
+
+
+_MAGIC = b"FSST"
+_VERSION = 1
+
+# Magic, version, width of codes, number of codes
+_HEADER = struct.Struct("<4sBBxxQ")
+
+
+class MmapStateTable(StateTable):
+    """
+    A table in a memory-mapped file at path with room for size IDs (0 to size - 1).
+    The file is created with all IDs empty if it doesn't exist, in which case size is required.
+    Otherwise size may be omitted, and the file is checked against machine.
+    Set readonly to map the file read-only, e.g. in reader processes.
+    """
+
+    def __init__(self, path, machine, size=None, readonly=False):
+        width = code_width(machine)
+        if not os.path.exists(path):
+            if size is None:
+                raise ValueError(f"{path} doesn't exist, so size is required to create it")
+            _create_file(path, width, size)
+
+        with open(path, "rb" if readonly else "r+b") as f:
+            self._mmap = mmap.mmap(
+                f.fileno(), 0,
+                access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE,
+            )
+
+        try:
+            _check_header(self._mmap, path, machine, size)
+        except ValueError:
+            self._mmap.close()
+            raise
+
+        self.path = path
+        buffer = memoryview(self._mmap)[_HEADER.size:]
+        try:
+            super().__init__(machine, buffer, readonly)
+        finally:
+            buffer.release()
+
+    def flush(self):
+        """
+        Writes the changes to disk now rather than whenever the OS decides to.
+        """
+        self._mmap.flush()
+
+    def close(self):
+        self.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _check_header(buffer, description, machine, size=None):
+    width = code_width(machine)
+    magic, version, actual_width, actual_size = _HEADER.unpack_from(buffer)
+    if (magic, version) != (_MAGIC, _VERSION):
+        raise ValueError(f"{description} is not a state table")
+    if actual_width != width or size not in (None, actual_size):
+        raise ValueError(
+            f"{description} has {actual_size} codes of {actual_width} bytes, "
+            f"but {machine} needs {width} bytes per code"
+            + ("" if size is None else f" and {size} codes were requested")
+        )
+
+
+def _create_file(path, width, size):
+    chunk = b"\xff" * (width * min(size, 65536))
+    remaining = width * size
+    with open(path, "xb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, width, size))
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining -= len(chunk)
+
+
+class TableState(BaseState):
+    __doc__ = globals()["__doc__"]
+
+    __slots__ = ()
+    table: StateTable = None
+
+    @classmethod
+    def get_id(cls, obj) -> int:
+        return obj
+
+    @classmethod
+    def initialize(cls, obj):
+        """
+        Stores this state as the state of obj, which mustn't have a state yet,
+        otherwise IncorrectInitialState is raised.
+        """
+        if not cls.is_state:
+            raise ValueError(f"{cls} is not a concrete state of a complete machine")
+        if not cls.table.compare_and_set(cls.get_id(obj), None, cls):
+            raise IncorrectInitialState("{obj} already has a state", obj=obj)
+
+    def get_state(self):
+        return self.table.get(self.get_id(self.obj))
+
+    def set_state(self, previous_state, new_state):
+        if not self.table.compare_and_set(self.get_id(self.obj), previous_state, new_state):
+            raise StateChangedElsewhere(
+                "The state of {obj} in the table is no longer {state}",
+                obj=self.obj,
+                state=previous_state,
+            )
+
+
+class SharedMemoryStateTable(StateTable):
+    """
+    A table with room for size IDs in a new block of shared memory,
+    named name or a random name, with compare-and-set protected by a number of locks
+    from the multiprocessing context, which is the default context if not given.
+    Pickling the table while starting a process attaches the new process to the same memory and locks.
+    The process which created the table should call unlink() when it's no longer needed,
+    which exiting a with block does.
+    """
+
+    def __init__(self, machine, size, name=None, stripes=64, context=None):
+        # Imported here as multiprocessing.shared_memory requires Python 3.8
+        from multiprocessing.shared_memory import SharedMemory
+
+        width = code_width(machine)
+        context = context or multiprocessing
+        shm = SharedMemory(name=name, create=True, size=_HEADER.size + width * size)
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, _VERSION, width, size)
+        shm.buf[_HEADER.size:_HEADER.size + width * size] = b"\xff" * (width * size)
+        self._created = True
+        self._setup(machine, shm, [context.Lock() for _ in range(stripes)])
+
+    def _setup(self, machine, shm, locks):
+        self._shm = shm
+        self._locks = locks
+        self.name = shm.name
+        _check_header(shm.buf, f"The shared memory {shm.name}", machine)
+        size = _HEADER.unpack_from(shm.buf)[3]
+        buffer = shm.buf[_HEADER.size:_HEADER.size + code_width(machine) * size]
+        try:
+            super().__init__(machine, buffer)
+        finally:
+            buffer.release()
+
+    def __reduce__(self):
+        return _attach_shared_memory_table, (self.machine, self.name, self._locks)
+
+    def _lock_for(self, id):
+        return self._locks[id % len(self._locks)]
+
+    def set(self, id, state):
+        with self._lock_for(id):
+            super().set(id, state)
+
+    def close(self):
+        """
+        Detaches this process from the shared memory.
+        """
+        self.release()
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Destroys the shared memory once all processes have closed it.
+        """
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        if self._created:
+            self.unlink()
+
+
+def _attach_shared_memory_table(machine, name, locks):
+    from multiprocessing.shared_memory import SharedMemory
+
+    table = SharedMemoryStateTable.__new__(SharedMemoryStateTable)
+    table._created = False
+    table._setup(machine, SharedMemory(name=name), locks)
+    return table
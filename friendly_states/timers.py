@@ -0,0 +1,131 @@
+"""
+Timed transitions, e.g. expiring an order which has been awaiting payment for 30 minutes:
+
+    class AwaitingPayment(OrderMachine):
+        timeout = timedelta(minutes=30)
+        on_timeout = "expire"
+
+        def expire(self) -> [Expired]:
+            pass
+
+TimeoutScheduler keeps track of objects in memory and applies the on_timeout
+transitions when they are due. For Django, see StateQuerySet.fire_timeouts
+which finds timed out rows in the database instead.
+"""
+import itertools
+import time
+from heapq import heappush, heappop
+from typing import List, Tuple, Any
+
+
+class TimeoutScheduler:
+    """
+    Tracks deadlines for objects of one machine in a heap, so that scheduling,
+    cancelling and firing are cheap even with millions of pending timeouts.
+
+    clock is a function returning the current time in seconds,
+    by default time.monotonic. Pass a fake clock for tests.
+
+    If retry_delay is given, objects whose timeout transition is rejected by a guard
+    or raises an exception are scheduled again retry_delay seconds after firing.
+    Otherwise they're no longer tracked after being reported by fire.
+    """
+
+    def __init__(self, machine, clock=time.monotonic, retry_delay=None):
+        self.machine = machine
+        self.clock = clock
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, obj, entered_at=None):
+        """
+        Starts tracking obj, which entered its current state at entered_at
+        (by default now), replacing any deadline it already had.
+        Returns the deadline, or None if the state of obj has no timeout.
+        """
+        self.cancel(obj)
+        _, state = self.machine._peek(obj)
+        timeout = self.machine.timeouts.get(state)
+        if timeout is None:
+            return None
+
+        if entered_at is None:
+            entered_at = self.clock()
+        deadline = entered_at + timeout[0]
+        self._push(obj, state, deadline)
+        return deadline
+
+    def _push(self, obj, state, deadline):
+        # [deadline, tie breaker, obj, state], obj is set to None when cancelled
+        entry = [deadline, next(self._counter), obj, state]
+        self._entries[id(obj)] = entry
+        heappush(self._heap, entry)
+
+    def cancel(self, obj):
+        """
+        Stops tracking obj, e.g. because it left its state by another transition.
+        Objects that have left their state are skipped when firing anyway,
+        so cancelling just saves memory.
+        """
+        entry = self._entries.pop(id(obj), None)
+        if entry is not None:
+            entry[2] = None
+
+    def fire(self, now=None, limit=None) -> List[Tuple[Any, Any]]:
+        """
+        Applies the on_timeout transition to objects whose deadlines are at or before
+        now (by default the current time), at most limit of them.
+        Objects which are no longer in the state they were scheduled in are skipped.
+        If an object enters another state with a timeout, it's scheduled again
+        from its deadline.
+
+        Returns a list of (obj, new_state) pairs, where new_state is None if the
+        transition wasn't possible, e.g. because of a guard, or the exception
+        if the transition raised one, e.g. StateChangedElsewhere.
+        Such objects are retried later if retry_delay is set.
+        """
+        if now is None:
+            now = self.clock()
+
+        heap = self._heap
+        results = []
+        while heap and heap[0][0] <= now and (limit is None or len(results) < limit):
+            deadline, _, obj, state = heappop(heap)
+            if obj is None:
+                continue
+
+            del self._entries[id(obj)]
+            _, current = state._peek(obj)
+            if current is None:
+                continue
+
+            try:
+                new_state = state.try_transition(obj, self.machine.timeouts[state][1])
+            except Exception as e:
+                results.append((obj, e))
+                new_state = None
+            else:
+                results.append((obj, new_state))
+
+            if new_state is not None:
+                self.schedule(obj, deadline)
+            elif self.retry_delay is not None:
+                _, current = self.machine._peek(obj)
+                if current in self.machine.timeouts:
+                    self._push(obj, current, now + self.retry_delay)
+
+        return results
+
+    def next_deadline(self):
+        """
+        Returns the earliest pending deadline, or None if there are none.
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heappop(heap)
+        return heap[0][0] if heap else None
@@ -26,7 +26,10 @@ tests_require = [
     'pytest',
     'pytest-pythonpath',
     'pytest-django',
+    'pytest-benchmark',
     'django',
+    'sqlalchemy',
+    'numpy',
     'jupyter',
     'nbconvert',
     'matplotlib',
@@ -49,6 +52,11 @@ setup(
     extras_require={
         'tests': tests_require,
     },
+    entry_points={
+        'console_scripts': [
+            'friendly-states-graph=friendly_states.graph:main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Programming Language :: Python :: 3.7',
@@ -3,6 +3,7 @@
 set -eux
 
 pytest
+python -m pytest benchmarks --benchmark-disable
 python transitions_example.py
 jupyter nbconvert --execute README.ipynb
 rm README.html
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_order'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='order',
+            name='entered_at',
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='state_changed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['state', 'state_changed_at'], name='myapp_order_state_6a9a78_idx'),
+        ),
+    ]
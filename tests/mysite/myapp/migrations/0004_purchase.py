@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_order_state_changed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Purchase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('regions', models.IntegerField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:33
+
+import friendly_states.django
+import myapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_purchase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(default='', max_length=100)),
+                ('state', friendly_states.django.StateField(myapp.models.DocumentMachine)),
+                ('review_state', friendly_states.django.StateField(myapp.models.ReviewMachine, null=True)),
+            ],
+        ),
+    ]
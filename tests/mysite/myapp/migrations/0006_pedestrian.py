@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:42
+
+import friendly_states.django
+import myapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Pedestrian',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', friendly_states.django.StateField(myapp.models.CrossingMachine)),
+                ('priority', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
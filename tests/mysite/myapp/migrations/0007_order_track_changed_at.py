@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:43
+
+import friendly_states.django
+import myapp.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_pedestrian'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='state',
+            field=friendly_states.django.StateField(myapp.models.OrderMachine, track_changed_at=True),
+        ),
+    ]
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+from datetime import timedelta
+
 from django.db import models
 
-from friendly_states.django import StateField, DjangoState
+from friendly_states.core import guard
+from friendly_states.django import StateField, DjangoState, StateQuerySet
+from friendly_states.regions import Regions, RegionState
 
 
 class TrafficLightMachine(DjangoState):
@@ -37,7 +41,8 @@ class NullableMachine(DjangoState):
 
 
 class NullableState(NullableMachine):
-    pass
+    def renew(self) -> [NullableState]:
+        pass
 
 
 NullableMachine.complete()
@@ -58,3 +63,178 @@ class MyModel(models.Model):
     state = StateField(TrafficLightMachine)
     nullable_state = StateField(NullableMachine, null=True)
     defaultable_state = StateField(DefaultableMachine, default=DefaultableState)
+
+    objects = StateQuerySet.as_manager()
+
+
+class CrossingMachine(DjangoState):
+    is_machine = True
+
+
+def has_priority(obj):
+    return obj.priority
+
+
+class Waiting(CrossingMachine):
+    @guard(has_priority, q=models.Q(priority=True))
+    def cross(self) -> [Crossing]:
+        pass
+
+    def leave(self) -> [Left]:
+        pass
+
+
+class Crossing(CrossingMachine):
+    pass
+
+
+class Left(CrossingMachine):
+    pass
+
+
+CrossingMachine.complete()
+
+
+class Pedestrian(models.Model):
+    state = StateField(CrossingMachine)
+    priority = models.BooleanField(default=False)
+
+    objects = StateQuerySet.as_manager()
+
+
+class OrderMachine(DjangoState):
+    is_machine = True
+
+
+class AwaitingPayment(OrderMachine):
+    timeout = timedelta(minutes=30)
+    on_timeout = "expire"
+
+    def pay(self) -> [Paid]:
+        pass
+
+    def expire(self) -> [Expired]:
+        pass
+
+
+class Paid(OrderMachine):
+    pass
+
+
+class Expired(OrderMachine):
+    pass
+
+
+OrderMachine.complete()
+
+
+class Order(models.Model):
+    state = StateField(OrderMachine, track_changed_at=True)
+
+    objects = StateQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["state", "state_changed_at"])]
+
+
+class PaymentMachine(RegionState):
+    is_machine = True
+
+
+class Unpaid(PaymentMachine):
+    code = 0
+
+    def pay(self) -> [Settled]:
+        pass
+
+
+class Settled(PaymentMachine):
+    code = 1
+
+    def refund(self) -> [Refunded]:
+        pass
+
+
+class Refunded(PaymentMachine):
+    code = 2
+
+
+PaymentMachine.complete()
+
+
+class FulfilmentMachine(RegionState):
+    is_machine = True
+
+
+class NotShipped(FulfilmentMachine):
+    code = 0
+
+    def ship(self) -> [Shipped]:
+        pass
+
+
+class Shipped(FulfilmentMachine):
+    code = 1
+
+
+FulfilmentMachine.complete()
+
+purchase_regions = Regions(PaymentMachine, FulfilmentMachine)
+
+
+class Purchase(models.Model):
+    regions = models.IntegerField(db_index=True)
+
+
+class ReviewMachine(DjangoState):
+    is_machine = True
+    attr_name = "review_state"
+
+
+class Drafting(ReviewMachine):
+    def submit(self) -> [InReview]:
+        pass
+
+
+class InReview(ReviewMachine):
+    def approve(self) -> [Approved]:
+        pass
+
+
+class Approved(ReviewMachine):
+    pass
+
+
+ReviewMachine.complete()
+
+
+class DocumentMachine(DjangoState):
+    is_machine = True
+
+
+class Draft(DocumentMachine):
+    def start_review(self) -> [Reviewing]:
+        pass
+
+
+class Reviewing(DocumentMachine):
+    submachine = ReviewMachine
+    initial_substate = Drafting
+
+    def publish(self) -> [Published]:
+        self.obj.title = self.obj.title.title()
+
+
+class Published(DocumentMachine):
+    pass
+
+
+DocumentMachine.complete()
+
+
+class Document(models.Model):
+    title = models.CharField(max_length=100, default="")
+    state = StateField(DocumentMachine)
+    review_state = StateField(ReviewMachine, null=True)
+
+    objects = StateQuerySet.as_manager()
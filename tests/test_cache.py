@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.cache import StateCache, CachedState
+from friendly_states.core import AttributeState
+from friendly_states.exceptions import StateChangedElsewhere, IncorrectInitialState
+from friendly_states.kv import KeyValueState, InMemoryClient, bulk_transition
+
+
+class Clock:
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class LightMachine(CachedState, KeyValueState):
+    is_machine = True
+    client = InMemoryClient()
+    cache = StateCache(maxsize=2, ttl=10, clock=Clock())
+
+
+class Green(LightMachine):
+    def slow_down(self) -> [Yellow]:
+        pass
+
+
+class Yellow(LightMachine):
+    def stop(self) -> [Red]:
+        pass
+
+
+class Red(LightMachine):
+    def go(self) -> [Green]:
+        pass
+
+
+LightMachine.complete()
+
+
+class DoorMachine(CachedState, AttributeState):
+    is_machine = True
+    cache = StateCache()
+
+
+class Open(DoorMachine):
+    def close(self) -> [Closed]:
+        pass
+
+    def slam(self) -> [Closed]:
+        # Don't do this
+        self.obj.state = Locked
+
+
+class Closed(DoorMachine):
+    def lock(self) -> [Locked]:
+        pass
+
+
+class Locked(DoorMachine):
+    pass
+
+
+DoorMachine.complete()
+
+
+def test_state_cache():
+    clock = Clock()
+    cache = StateCache(maxsize=2, ttl=10, clock=clock)
+    assert cache.get(1) is None
+    cache.set(1, Green)
+    cache.set(2, Red)
+    assert cache.get(1) is Green
+    cache.set(3, Yellow)
+    assert len(cache) == 2
+    assert cache.get(2, "missing") == "missing"
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    clock.time = 9
+    assert cache.get(3) is Yellow
+    clock.time = 10
+    assert cache.get(3) is None
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+    cache.set(1, Green)
+    cache.invalidate(1)
+    cache.invalidate(2)
+    assert cache.get(1) is None
+    cache = StateCache()
+    cache.set(1, Green)
+    clock.time = 10 ** 9
+    assert cache.get(1) is Green
+
+
+def test_cached_state():
+    client = LightMachine.client
+    cache = LightMachine.cache
+    Green.initialize(1)
+    client.round_trips = 0
+
+    state = LightMachine(1)
+    state.slow_down()
+    # The check before the write reads the backend
+    assert client.round_trips == 3
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    state.stop()
+    assert client.round_trips == 5
+    assert type(LightMachine(1)) is Red
+    assert client.round_trips == 5
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Changed elsewhere: the stale entry is only used to instantiate
+    client.data["state:1"] = "Yellow"
+    state = Red(1)
+    with pytest.raises(StateChangedElsewhere):
+        state.go()
+    assert client.data["state:1"] == "Yellow"
+    assert cache.get(1) is Yellow
+    assert type(LightMachine(1)) is Yellow
+
+    client.data["state:1"] = "Green"
+    with pytest.raises(IncorrectInitialState):
+        Red(1)
+    assert LightMachine.refresh(1) is Green
+    assert cache.get(1) is Green
+
+    LightMachine.cache.clock.time = 100
+    client.round_trips = 0
+    assert type(LightMachine(1)) is Green
+    assert client.round_trips == 1
+
+
+def test_bulk_transition():
+    client = LightMachine.client
+    cache = LightMachine.cache
+    cache.clear()
+    client.data.clear()
+    Green.initialize(1)
+    Green.initialize(2)
+    assert LightMachine.refresh(1) is Green
+    assert LightMachine.refresh(2) is Green
+
+    original_cas_many = client.compare_and_set_many
+
+    def compare_and_set_many(items):
+        # Nothing is cached before the batch is written
+        assert cache.get(1) is None
+        assert cache.get(2) is None
+
+        # Another process wins the race for one of the lights
+        client.data["state:2"] = "Red"
+        return original_cas_many(items)
+
+    client.compare_and_set_many = compare_and_set_many
+    try:
+        result = bulk_transition([(1, Green.slow_down), (2, Green.slow_down)])
+    finally:
+        del client.compare_and_set_many
+
+    assert result.succeeded == [1]
+    assert [(obj, type(error)) for obj, error in result.errors] == [(2, StateChangedElsewhere)]
+    assert cache.get(1) is Yellow
+    assert cache.get(2) is None
+    assert type(LightMachine(2)) is Red
+
+
+def test_attribute_state(monkeypatch):
+    door = SimpleNamespace(id=1, state=Open)
+    with pytest.raises(TypeError):
+        Open(door)
+    monkeypatch.setattr(DoorMachine, "cache_key", lambda self: self.obj.id)
+
+    state = Open(door)
+    assert DoorMachine.cache.get(1) is Open
+
+    # The state changed inside the transition isn't overwritten
+    with pytest.raises(StateChangedElsewhere):
+        state.slam()
+    assert door.state is Locked
+    assert DoorMachine.cache.get(1) is Locked
+
+    # Nor is a state changed since it was cached
+    door.state = Open
+    assert DoorMachine.refresh(door) is Open
+    state = Open(door)
+    door.state = Closed
+    with pytest.raises(StateChangedElsewhere):
+        state.close()
+    assert door.state is Closed
+    Closed(door).lock()
+    assert door.state is Locked
+    assert DoorMachine.cache.get(1) is Locked
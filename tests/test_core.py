@@ -6,10 +6,11 @@ from types import SimpleNamespace
 
 import pytest
 
-from friendly_states.core import AttributeState, IncorrectInitialState, BaseState, MappingKeyState, extract_state_names
+from friendly_states.core import AttributeState, IncorrectInitialState, BaseState, MappingKeyState, extract_state_names, \
+    guard, check_guards
 from friendly_states.exceptions import StateChangedElsewhere, IncorrectSummary, MultipleMachineAncestors, \
     InheritedFromState, CannotInferOutputState, DuplicateStateNames, DuplicateOutputStates, UnknownOutputState, \
-    ReturnedInvalidState, GetStateDidNotReturnState
+    ReturnedInvalidState, GetStateDidNotReturnState, TransitionNotAvailable, GuardFailed
 
 
 def my_deco(f):
@@ -76,7 +77,7 @@ OtherMachine.complete()
 @contextmanager
 def raises(exception_class, match=None, **kwargs):
     with pytest.raises(exception_class, match=match) as exc_info:
-        yield
+        yield exc_info
     exc = exc_info.value
     for key, value in kwargs.items():
         assert getattr(exc, key) == value
@@ -101,6 +102,311 @@ def test_transitions():
         Red(light)
 
 
+def test_reuse_instance():
+    light = StatefulThing(Green)
+    state = TrafficLightMachine(light)
+    assert type(state) is Green
+    state.slow_down()
+    assert type(state) is Yellow
+    state.stop()
+    state.go()
+    assert light.state is Green
+    assert type(state) is Green
+
+    light.state = Red
+    with raises(StateChangedElsewhere):
+        state.slow_down()
+
+
+def test_changed_at():
+    class Machine(AttributeState):
+        is_machine = True
+        changed_at_attr_name = "changed_at"
+        times = iter(range(10))
+
+        def current_time(self):
+            return next(self.times)
+
+    class S1(Machine):
+        def to_s2(self) -> [S2]:
+            pass
+
+    class S2(Machine):
+        pass
+
+    Machine.complete()
+
+    thing = SimpleNamespace(state=S1)
+    S1(thing).to_s2()
+    assert thing.state is S2
+    assert thing.changed_at == 0
+
+    thing = StatefulThing(Green)
+    Green(thing).slow_down()
+    assert not hasattr(thing, "changed_at")
+
+
+def test_slots():
+    class Machine(AttributeState):
+        is_machine = True
+        __slots__ = ()
+
+    class Parent(Machine):
+        is_abstract = True
+
+        def to_s2(self) -> [S2]:
+            pass
+
+    class S1(Parent):
+        pass
+
+    class S2(Machine):
+        pass
+
+    with pytest.raises(
+            ValueError,
+            match="Classes in a machine with __slots__ cannot declare their own slots",
+    ):
+        class S3(Machine):
+            __slots__ = ("x",)
+
+        str(S3)
+
+    Machine.complete()
+
+    assert S1.__slots__ == Parent.__slots__ == S2.__slots__ == ()
+
+    thing = StatefulThing(S1)
+    state = S1(thing)
+    assert not hasattr(state, "__dict__")
+    with pytest.raises(AttributeError):
+        state.y = 1
+
+    state.to_s2()
+    assert thing.state is S2
+
+    # Other machines are unaffected
+    assert hasattr(Green(StatefulThing(Green)), "__dict__")
+
+
+def test_lazy_message():
+    class CountingRepr(StatefulThing):
+        reprs = 0
+
+        def __repr__(self):
+            CountingRepr.reprs += 1
+            return "light"
+
+    light = CountingRepr(Green)
+    with pytest.raises(IncorrectInitialState) as exc_info:
+        Red(light)
+
+    exc = exc_info.value
+    assert CountingRepr.reprs == 0
+    assert exc.obj is light
+    assert exc.message_format == "{obj} should be in state {desired} but is actually in state {state}"
+    assert str(exc) == exc.message == "light should be in state Red but is actually in state Green"
+    assert CountingRepr.reprs == 1
+
+
+def test_non_raising_apis():
+    assert Green.can(Green.slow_down)
+    assert not Green.can(Yellow.stop)
+
+    light = StatefulThing(Green)
+    assert TrafficLightMachine.allowed(light) == {Green.slow_down}
+    assert Green.allowed(light) == {Green.slow_down}
+    assert Red.allowed(light) == set()
+
+    assert TrafficLightMachine.try_transition(light, Yellow.stop) is None
+    assert Red.try_transition(light, Green.slow_down) is None
+    assert light.state is Green
+    assert TrafficLightMachine.try_transition(light, Green.slow_down) is Yellow
+    assert light.state is Yellow
+    assert Yellow.try_transition(light, Yellow.stop) is Red
+
+    # Not a state of this machine
+    light.state = State1
+    assert TrafficLightMachine.allowed(light) == set()
+    assert TrafficLightMachine.try_transition(light, Green.slow_down) is None
+
+    class Machine(AttributeState):
+        is_machine = True
+
+    with pytest.raises(ValueError, match="This machine is not complete"):
+        Machine.allowed(light)
+
+
+def test_dispatch():
+    light = StatefulThing(Green)
+    assert TrafficLightMachine.dispatch(light, "slow_down") is Yellow
+    assert light.state is Yellow
+    assert Yellow.dispatch(light, "stop") is Red
+
+    with raises(
+            TransitionNotAvailable,
+            state=Red,
+            name="stop",
+            available=["go"],
+            message="StatefulThing(state=Red) is in state Red, which has no transition named stop. "
+                    "The available transitions are: ['go']",
+    ):
+        TrafficLightMachine.dispatch(light, "stop")
+
+    with raises(IncorrectInitialState):
+        Green.dispatch(light, "slow_down")
+
+
+def test_submachines():
+    class ShipmentMachine(AttributeState):
+        is_machine = True
+        attr_name = "shipment"
+
+    class Packing(ShipmentMachine):
+        def ship(self) -> [InTransit]:
+            pass
+
+    class InTransit(ShipmentMachine):
+        def deliver(self) -> [Delivered]:
+            pass
+
+        def cancel(self) -> [Packing]:
+            pass
+
+    class Delivered(ShipmentMachine):
+        pass
+
+    ShipmentMachine.complete()
+
+    class OrderMachine(AttributeState):
+        is_machine = True
+
+    class Placed(OrderMachine):
+        def fulfil(self) -> [Fulfilling]:
+            pass
+
+    class Fulfilling(OrderMachine):
+        submachine = ShipmentMachine
+        initial_substate = Packing
+
+        def cancel(self) -> [Placed]:
+            pass
+
+        def finish(self) -> [Done]:
+            pass
+
+    class Done(OrderMachine):
+        pass
+
+    OrderMachine.complete()
+    assert Fulfilling._entry_chain == ((ShipmentMachine, Packing),)
+
+    order = SimpleNamespace(state=Placed, shipment=None)
+    assert OrderMachine.dispatch(order, "fulfil") is Fulfilling
+    assert order.shipment is Packing
+
+    # Falls through to the substate, whose transitions come first
+    assert OrderMachine.dispatch(order, "ship") is InTransit
+    assert order.state is Fulfilling
+    assert OrderMachine.dispatch(order, "cancel") is Packing
+    assert order.state is Fulfilling
+    assert OrderMachine.dispatch(order, "cancel") is Placed
+    assert order.shipment is None
+
+    OrderMachine.dispatch(order, "fulfil")
+    OrderMachine.dispatch(order, "ship")
+    with raises(
+            TransitionNotAvailable,
+            available=["cancel", "deliver", "finish"],
+    ):
+        OrderMachine.dispatch(order, "go")
+    Fulfilling(order).finish()
+    assert order.state is Done
+    assert order.shipment is None
+
+    class Machine(AttributeState):
+        is_machine = True
+
+    class Parent(Machine):
+        submachine = ShipmentMachine
+        initial_substate = Placed
+
+    with pytest.raises(ValueError):
+        Machine.complete()
+
+    Parent.initial_substate = Packing
+    Parent.final_substate = Delivered
+    Machine.complete()
+    Parent.submachine = Placed
+    with pytest.raises(ValueError):
+        Machine.complete()
+
+    # The submachine can't overwrite the state of its parent
+    Parent.submachine = ShipmentMachine
+    Machine.complete()
+    ShipmentMachine.attr_name = "state"
+    try:
+        with pytest.raises(ValueError):
+            Machine.complete()
+    finally:
+        ShipmentMachine.attr_name = "shipment"
+
+
+def test_guards():
+    def is_big(obj):
+        return obj.size > 10
+
+    def is_even(obj):
+        return obj.size % 2 == 0
+
+    class Machine(AttributeState):
+        is_machine = True
+
+    class Small(Machine):
+        @guard(is_big, q="big")
+        @guard(is_even)
+        def grow(self) -> [Big]:
+            pass
+
+        def stay(self) -> [Small]:
+            pass
+
+    class Big(Machine):
+        pass
+
+    Machine.complete()
+
+    assert [g.predicate for g in Small.grow.guards] == [is_big, is_even]
+    assert Small.grow.guards[0].q == "big"
+    assert Small.stay.guards == ()
+
+    things = [SimpleNamespace(state=Small, size=size) for size in [5, 11, 12]]
+    assert check_guards(Small.grow, things) == [False, False, True]
+    assert [Machine.allowed(thing) for thing in things] == [
+        {Small.stay},
+        {Small.stay},
+        {Small.stay, Small.grow},
+    ]
+
+    small, odd, big = things
+    with raises(
+            GuardFailed,
+            obj=small,
+            guard=Small.grow.guards[0],
+            match="The guard is_big of the transition <function test_guards.<locals>.Small.grow at 0x\\w+> "
+                  "rejected namespace\\(state=Small, size=5\\)",
+    ):
+        Small(small).grow()
+    assert small.state is Small
+
+    with raises(GuardFailed, guard=Small.grow.guards[1]):
+        Small(odd).grow()
+
+    assert Machine.try_transition(odd, Small.grow) is None
+    assert Machine.try_transition(big, Small.grow) is Big
+    assert big.state is Big
+
+
 def test_state_changed_elsewhere():
     obj = StatefulThing(State1)
     with raises(
@@ -120,6 +426,8 @@ def test_attributes():
     assert Green.label == "Green"
     assert Green.output_states == {Yellow}
     assert Green.slow_down.output_states == {Yellow}
+    assert Green.slow_down.machine is TrafficLightMachine
+    assert Green.transitions == {Green.slow_down}
     assert TrafficLightMachine.states == {Green, Yellow, Red}
     assert OtherMachine.states == {State1, State2}
     with pytest.raises(AttributeError):
@@ -141,9 +449,23 @@ Outputs of Green:
 According to summary       : Red, Yellow
 According to actual classes: Yellow
 
-"""):
+""") as exc_info:
         TrafficLightMachine.check_summary(Graph)
 
+    diff = exc_info.value.diff
+    assert diff == TrafficLightMachine.diff_summary(Graph)
+    assert diff.missing_states == {}
+    assert diff.wrong_outputs == {"Green": ({"Red", "Yellow"}, {"Yellow"})}
+    assert diff.missing_edges == {("Green", "Red")}
+    assert diff.extra_edges == set()
+
+    assert not TrafficLightMachine.diff_summary(TrafficLightMachine.Summary)
+    assert TrafficLightMachine.adjacency == {
+        "Green": {"Yellow"},
+        "Yellow": {"Red"},
+        "Red": {"Green"},
+    }
+
 
 def test_repr():
     assert repr(BaseState) == "<class 'friendly_states.core.BaseState'>"
@@ -168,6 +490,7 @@ def test_abstract_classes():
     class Parent(MyMachine):
         is_abstract = True
         x = 9
+        unhashable = []
 
         def to_loner(self) -> [Loner]:
             pass
@@ -218,6 +541,16 @@ def test_abstract_classes():
     assert Child1.direct_transitions == {Child1.to_child2}
     assert Child1.transitions == {Child1.to_child2, Parent.to_loner}
 
+    assert MyMachine.dispatch_table == {
+        (Loner, "to_child1"): Loner.to_child1,
+        (Child1, "to_loner"): Parent.to_loner,
+        (Child1, "to_child2"): Child1.to_child2,
+        (Child2, "to_loner"): Parent.to_loner,
+        (Child2, "to_child1"): Child2.to_child1,
+    }
+    assert MyMachine.dispatch(thing, "to_child1") is Child1
+    assert thing["state"] is Child1
+
 
 def test_multiple_machines():
     class Machine1(AttributeState):
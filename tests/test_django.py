@@ -1,12 +1,22 @@
+import asyncio
+import threading
+from datetime import timedelta
+
 import pytest
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, models
+from django.db import IntegrityError, DatabaseError, models, connection, connections
 from django.db.transaction import atomic
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from friendly_states.core import AttributeState
-from friendly_states.django import StateField, DjangoState
-from friendly_states.exceptions import DjangoStateAttrNameWarning
-from myapp.models import MyModel, Green, Yellow, Red, DefaultableState, NullableState, TrafficLightMachine
+from friendly_states import django as django_module
+from friendly_states.core import AttributeState, guard
+from friendly_states.django import StateField, DjangoState, BatchCommitter, regions_q
+from friendly_states.exceptions import DjangoStateAttrNameWarning, TransitionNotAvailable, StateChangedElsewhere, \
+    IncorrectInitialState, GuardFailed
+from myapp.models import MyModel, Green, Yellow, Red, DefaultableState, NullableState, TrafficLightMachine, \
+    Order, AwaitingPayment, Paid, Expired, Purchase, purchase_regions, Unpaid, Settled, Refunded, NotShipped, \
+    Shipped, Pedestrian, Waiting, Crossing, Document, DocumentMachine, Draft, Reviewing, Published, Drafting, InReview, Approved
 
 
 def get_lights(counts):
@@ -198,3 +208,570 @@ def test_change_attr_name():
             state = StateField(BadMachine)
 
         str(Model)
+
+
+@pytest.mark.django_db
+def test_annotate_transitions():
+    MyModel.objects.create(state=Green)
+    MyModel.objects.create(state=Red)
+
+    objs = MyModel.objects.with_transitions().with_output_states().order_by("id")
+    green, red = objs
+    assert green.state_transitions == {"to_yellow"}
+    assert green.state_output_states == {Yellow}
+    assert red.state_transitions == {"to_green"}
+    assert red.state_output_states == {Green}
+
+    (obj,) = MyModel.objects.with_transitions("nullable_state", annotation_name="transitions")[:1]
+    assert obj.transitions is None
+
+    (obj,) = MyModel.objects.with_transitions("defaultable_state")[:1]
+    assert obj.defaultable_state_transitions == frozenset()
+
+    assert list(
+        MyModel.objects
+            .with_transitions()
+            .filter(state_transitions="to_green")
+            .values_list("state", flat=True)
+    ) == [Red]
+
+    with pytest.raises(TypeError, match="id is not a StateField"):
+        MyModel.objects.with_transitions("id")
+
+
+def test_bulk_conversions():
+    field = StateField(TrafficLightMachine)
+    assert field.to_states(["Green", None, "Red"]) == [Green, None, Red]
+    assert field.to_slugs([Green, None, "Red"]) == ["Green", None, "Red"]
+    assert field.from_db_value("Yellow", None, None) is Yellow
+
+    with pytest.raises(KeyError):
+        field.to_states(["Purple"])
+
+    with pytest.raises(
+            ValidationError,
+            match=r"Purple is not one of the valid slugs for this machine: \['Green', 'Red', 'Yellow'\]",
+    ):
+        field.to_slugs([Green, "Purple"])
+
+    # One-shot iterators are only consumed once
+    assert field.to_slugs(iter([Green, "Red"])) == ["Green", "Red"]
+    with pytest.raises(ValidationError, match="Purple"):
+        field.to_slugs(value for value in [Green, "Purple"])
+
+    with pytest.raises(
+            ValidationError,
+            match="should be a state class, a string, or None, not \\[\\]",
+    ):
+        field.to_slugs([[]])
+
+
+@pytest.mark.django_db
+def test_bulk_transition(django_assert_num_queries):
+    green1, green2, red, yellow = [
+        MyModel.objects.create(state=state)
+        for state in [Green, Green, Red, Yellow]
+    ]
+
+    with django_assert_num_queries(1):
+        result = MyModel.objects.bulk_transition([
+            (green1, Green.to_yellow),
+            (green2, Green.to_yellow),
+            (red, Red.to_green),
+            (yellow, Green.to_yellow),
+        ])
+
+    assert result.succeeded == [green1, green2, red]
+    ((obj, error),) = result.errors
+    assert obj is yellow
+    assert isinstance(error, TransitionNotAvailable)
+    assert str(error) == "MyModel object ({}) is in state Yellow, which doesn't have the transition {}".format(
+        yellow.id, Green.to_yellow,
+    )
+
+    assert green1.state is Yellow
+    assert red.state is Green
+    assert yellow.state is Yellow
+    get_lights([1, 3, 0])
+
+    # Chained transitions of one object are merged into one change
+    with django_assert_num_queries(1):
+        result = MyModel.objects.bulk_transition([
+            (green1, Yellow.to_red),
+            (green1, Red.to_green),
+            (green2, Yellow.to_red),
+        ])
+    assert result.succeeded == [green1, green1, green2]
+    assert not result.errors
+    get_lights([2, 1, 1])
+
+    # The row changed in the database since the object was loaded
+    MyModel.objects.filter(id=green1.id).update(state=Red)
+    with django_assert_num_queries(2):
+        result = MyModel.objects.bulk_transition([
+            (green1, Green.to_yellow),
+            (red, Green.to_yellow),
+        ])
+    assert result.succeeded == [red]
+    ((obj, error),) = result.errors
+    assert obj is green1
+    assert isinstance(error, StateChangedElsewhere)
+    assert error.state is Green
+    assert green1.state is Green
+    get_lights([0, 2, 2])
+
+    # Transitions which end in the original state still check the row
+    MyModel.objects.filter(id=green1.id).update(state=Yellow)
+    with django_assert_num_queries(2):
+        result = MyModel.objects.bulk_transition([
+            (green1, Green.to_yellow),
+            (green1, Yellow.to_red),
+            (green1, Red.to_green),
+        ])
+    assert result.succeeded == []
+    assert [type(error) for _, error in result.errors] == [StateChangedElsewhere]
+    assert green1.state is Green
+    get_lights([0, 3, 1])
+
+
+@pytest.mark.django_db
+def test_bulk_transition_models(monkeypatch):
+    light = MyModel.objects.create(state=Green)
+    order = Order.objects.create(state=AwaitingPayment)
+
+    # Objects of other models, e.g. transitioned by a transition body, are saved too
+    result = MyModel.objects.bulk_transition([(light, Green.to_yellow), (order, AwaitingPayment.expire)])
+    assert result.succeeded == [light, order]
+    assert not result.errors
+    assert MyModel.objects.get(id=light.id).state is Yellow
+    assert Order.objects.get(id=order.id).state is Expired
+
+    # If a later UPDATE fails, the earlier ones are rolled back with the objects
+    original = django_module._conditional_update
+    calls = []
+
+    def conditional_update(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise DatabaseError("connection lost")
+        return original(*args)
+
+    order = Order.objects.create(state=AwaitingPayment)
+    monkeypatch.setattr(django_module, "_conditional_update", conditional_update)
+    with pytest.raises(DatabaseError):
+        MyModel.objects.bulk_transition([(light, Yellow.to_red), (order, AwaitingPayment.pay)])
+    assert (light.state, order.state) == (Yellow, AwaitingPayment)
+    assert MyModel.objects.get(id=light.id).state is Yellow
+    assert Order.objects.get(id=order.id).state is AwaitingPayment
+
+
+@pytest.mark.django_db
+def test_bulk_transition_database_error(monkeypatch):
+    red = MyModel.objects.create(state=Red)
+
+    def update(*args, **kwargs):
+        raise DatabaseError("connection lost")
+
+    monkeypatch.setattr(models.QuerySet, "update", update)
+    with pytest.raises(DatabaseError):
+        MyModel.objects.bulk_transition([(red, Red.to_green), (red, Green.to_yellow)])
+    assert red.state is Red
+
+
+@pytest.mark.django_db
+def test_select_for_update(monkeypatch, django_assert_num_queries):
+    monkeypatch.setattr(TrafficLightMachine, "select_for_update", True)
+    obj = MyModel.objects.create(state=Green)
+
+    # Changed elsewhere, the lock gets the latest state,
+    # which is only copied to the object if it's the expected state
+    MyModel.objects.filter(id=obj.id).update(state=Red)
+    with pytest.raises(IncorrectInitialState):
+        with Green.locked(obj):
+            pass
+    assert obj.state is Green
+
+    with Red.locked(obj) as state:
+        assert obj.state is Red
+        state.to_green()
+    get_lights([1, 0, 0])
+
+    # The methods which don't call __init__ also lock the row and use its state
+    MyModel.objects.filter(id=obj.id).update(state=Red)
+    with atomic():
+        assert TrafficLightMachine.try_transition(obj, Green.to_yellow) is None
+    assert obj.state is Red
+    with atomic():
+        assert TrafficLightMachine.allowed(obj) == {Red.to_green}
+        assert TrafficLightMachine.dispatch(obj, "to_green") is Green
+    get_lights([1, 0, 0])
+
+    # Bulk transitions rely on the conditional UPDATE instead of locking each row
+    with django_assert_num_queries(1):
+        result = MyModel.objects.bulk_transition([(obj, Green.to_yellow)])
+    assert result.succeeded == [obj]
+    get_lights([0, 1, 0])
+
+    other = MyModel.objects.get(id=obj.id)
+    obj.delete()
+    with pytest.raises(MyModel.DoesNotExist):
+        with Yellow.locked(other):
+            pass
+
+    # A deleted row is indistinguishable from a locked one with SKIP LOCKED
+    monkeypatch.setattr(TrafficLightMachine, "skip_locked", True)
+    with Yellow.locked(other) as state:
+        assert state is None
+
+
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="Requires row locks")
+@pytest.mark.django_db(transaction=True)
+def test_skip_locked(monkeypatch):
+    monkeypatch.setattr(TrafficLightMachine, "select_for_update", True)
+    monkeypatch.setattr(TrafficLightMachine, "skip_locked", True)
+    obj = MyModel.objects.create(state=Green)
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        try:
+            with Green.locked(MyModel.objects.get(id=obj.id)) as state:
+                assert state is not None
+                locked.set()
+                release.wait(10)
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    try:
+        assert locked.wait(10)
+        with Green.locked(obj) as state:
+            assert state is None
+    finally:
+        release.set()
+        thread.join()
+
+    with Green.locked(obj) as state:
+        assert state is not None
+
+
+@pytest.mark.django_db
+def test_claim(django_assert_num_queries):
+    objs = [MyModel.objects.create(state=Green) for _ in range(5)]
+    MyModel.objects.create(state=Red)
+    queryset = MyModel.objects.order_by("id")
+
+    with django_assert_num_queries(4):  # SAVEPOINT, SELECT, UPDATE, RELEASE
+        result = Green.claim(queryset, limit=3, transition=Green.to_yellow)
+    assert result.succeeded == objs[:3]
+    assert not result.errors
+    assert all(obj.state is Yellow for obj in result.succeeded)
+    get_lights([2, 3, 1])
+
+    result = Green.claim(queryset, limit=3, transition=Green.to_yellow)
+    assert result.succeeded == objs[3:]
+    get_lights([0, 5, 1])
+
+    result = Green.claim(queryset, limit=3, transition=Green.to_yellow)
+    assert result == ([], [])
+
+
+@pytest.mark.django_db
+def test_guards():
+    waiting = Pedestrian.objects.create(state=Waiting)
+    priority = Pedestrian.objects.create(state=Waiting, priority=True)
+    Pedestrian.objects.create(state=Crossing, priority=True)
+
+    assert list(Pedestrian.objects.filter_transition(Waiting.cross)) == [priority]
+    assert Pedestrian.objects.filter_transition(Waiting.leave).count() == 2
+
+    result = Pedestrian.objects.bulk_transition([
+        (waiting, Waiting.cross),
+        (priority, Waiting.cross),
+    ])
+    assert result.succeeded == [priority]
+    ((obj, error),) = result.errors
+    assert obj is waiting
+    assert isinstance(error, GuardFailed)
+    assert Pedestrian.objects.filter(state=Crossing).count() == 2
+
+    result = Waiting.claim(Pedestrian.objects.all(), limit=10, transition=Waiting.cross)
+    assert result == ([], [])
+
+    with pytest.raises(ValueError, match="The guard <lambda> of the transition to_red has no Q object"):
+        class Machine(DjangoState):
+            is_machine = True
+
+        class S(Machine):
+            @guard(lambda obj: True)
+            def to_red(self) -> '[S]':
+                pass
+
+        Machine.complete()
+        MyModel.objects.filter_transition(S.to_red)
+
+
+@pytest.mark.django_db
+def test_fire_timeouts():
+    now = timezone.now()
+    old, older, recent = [
+        Order.objects.create(state=AwaitingPayment, state_changed_at=now - timedelta(minutes=minutes))
+        for minutes in [31, 40, 10]
+    ]
+    Order.objects.create(state=Paid, state_changed_at=now - timedelta(days=1))
+
+    assert set(Order.objects.timed_out(now=now)) == {old, older}
+    assert set(Order.objects.timed_out("state_changed_at", now=now)) == {old, older}
+    with pytest.raises(TypeError):
+        MyModel.objects.timed_out()
+    assert list(MyModel.objects.timed_out("id")) == []
+
+    result = Order.objects.order_by("state_changed_at").fire_timeouts(now=now, limit=1)
+    assert [obj.id for obj in result.succeeded] == [older.id]
+    assert result.succeeded[0].state is Expired
+
+    result = Order.objects.fire_timeouts(now=now)
+    assert [obj.id for obj in result.succeeded] == [old.id]
+    assert not result.errors
+
+    assert Order.objects.get(id=recent.id).state is AwaitingPayment
+    assert Order.objects.filter(state=Expired).count() == 2
+
+
+@pytest.mark.django_db
+def test_track_changed_at():
+    field = Order._meta.get_field("state")
+    assert field.changed_at_field is Order._meta.get_field("state_changed_at")
+    assert field.deconstruct()[3]["track_changed_at"] is True
+    assert [index.fields for index in Order._meta.indexes] == [["state", "state_changed_at"]]
+    assert MyModel._meta.get_field("state").changed_at_field is None
+
+    before = timezone.now()
+    order = Order.objects.create(state=AwaitingPayment)
+    created_at = order.state_changed_at
+    assert created_at >= before
+
+    AwaitingPayment(order).pay()
+    assert order.state_changed_at > created_at
+    assert Order.objects.get(id=order.id).state_changed_at == order.state_changed_at
+
+    orders = [Order.objects.create(state=AwaitingPayment) for _ in range(3)]
+    Order.objects.filter(id=orders[2].id).update(state=Paid)
+    result = Order.objects.bulk_transition([(order, AwaitingPayment.expire) for order in orders])
+    assert result.succeeded == orders[:2]
+    saved = {obj.id: obj.state_changed_at for obj in Order.objects.all()}
+    for order in orders[:2]:
+        assert order.state_changed_at > created_at
+        assert saved[order.id] == order.state_changed_at
+    assert saved[orders[2].id] == orders[2].state_changed_at < orders[0].state_changed_at
+
+
+@pytest.mark.django_db(transaction=True)
+def test_batch_committer(monkeypatch):
+    lights = [MyModel.objects.create(state=Green) for _ in range(5)]
+    MyModel.objects.filter(id=lights[3].id).update(state=Red)
+    batches = []
+    save_changes = django_module._save_changes
+
+    def record_batch(changes, using):
+        batches.append(len(changes))
+        assert connections[using or "default"].in_atomic_block
+        return save_changes(changes, using)
+
+    monkeypatch.setattr(django_module, "_save_changes", record_batch)
+
+    async def main():
+        committer = BatchCommitter(delay=0.01, max_size=4)
+        results = await asyncio.gather(
+            *[committer.transition(light, Green.to_yellow) for light in lights],
+            committer.transition(lights[0], Green.to_yellow),
+            return_exceptions=True,
+        )
+        await committer.flush()
+        return results
+
+    results = asyncio.run(main())
+
+    # The first 4 transitions fill a batch, the last one is saved after the delay
+    assert batches == [4, 1]
+
+    assert results[:3] == [Yellow] * 3
+    assert isinstance(results[3], StateChangedElsewhere)
+    assert results[4] is Yellow
+    assert isinstance(results[5], TransitionNotAvailable)
+    assert [light.state for light in lights] == [Yellow, Yellow, Yellow, Green, Yellow]
+    get_lights([0, 4, 1])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_batch_committer_fields():
+    obj = MyModel.objects.create(state=Green, nullable_state=NullableState)
+    MyModel.objects.filter(id=obj.id).update(state=Red)
+
+    async def main():
+        committer = BatchCommitter()
+        results = await asyncio.gather(
+            committer.transition(obj, Green.to_yellow),
+            committer.transition(obj, NullableState.renew),
+            return_exceptions=True,
+        )
+        await committer.flush()
+        return results
+
+    # Only the field which changed elsewhere fails
+    state_result, nullable_result = asyncio.run(main())
+    assert isinstance(state_result, StateChangedElsewhere)
+    assert nullable_result is NullableState
+    assert obj.state is Green
+    assert obj.nullable_state is NullableState
+
+    async def fail():
+        def run_sync(func):
+            raise DatabaseError("connection lost")
+
+        committer = BatchCommitter(run_sync=run_sync)
+        return await asyncio.gather(
+            committer.transition(obj, Red.to_green),
+            committer.transition(obj, NullableState.renew),
+            return_exceptions=True,
+        )
+
+    # Every field is restored when the batch fails
+    obj.state = Red
+    obj.nullable_state = NullableState
+    results = asyncio.run(fail())
+    assert [type(result) for result in results] == [DatabaseError, DatabaseError]
+    assert obj.state is Red
+
+
+@pytest.mark.django_db
+def test_unit_of_work(django_assert_num_queries):
+    green, red, yellow = [MyModel.objects.create(state=state) for state in [Green, Red, Yellow]]
+
+    with CaptureQueriesContext(connection) as queries:
+        with TrafficLightMachine.unit_of_work():
+            with django_assert_num_queries(0):
+                Green(green).to_yellow()
+                Yellow(green).to_red()
+                Red(red).to_green()
+                with TrafficLightMachine.unit_of_work():
+                    Yellow(yellow).to_red()
+            assert green.state is Red
+            assert MyModel.objects.get(id=green.id).state is Green
+
+    assert [query["sql"].split()[0] for query in queries].count("UPDATE") == 1
+    assert [green.state, red.state, yellow.state] == [Red, Green, Red]
+    get_lights([1, 0, 2])
+
+    with pytest.raises(ZeroDivisionError):
+        with TrafficLightMachine.unit_of_work():
+            Red(green).to_green()
+            Green(green).to_yellow()
+            Green(red).to_yellow()
+            1 / 0
+    assert [green.state, red.state] == [Red, Green]
+    get_lights([1, 0, 2])
+
+    MyModel.objects.filter(id=yellow.id).update(state=Yellow)
+    with pytest.raises(StateChangedElsewhere) as exc_info:
+        with TrafficLightMachine.unit_of_work():
+            Green(red).to_yellow()
+            Red(yellow).to_green()
+    assert exc_info.value.obj is yellow
+    assert exc_info.value.state is Red
+    assert [red.state, yellow.state] == [Green, Red]
+    get_lights([1, 1, 1])
+
+
+@pytest.mark.django_db
+def test_unit_of_work_scope(monkeypatch, django_assert_num_queries):
+    green, red = [MyModel.objects.create(state=state) for state in [Green, Red]]
+
+    # bulk_transition joins the unit of work
+    with django_assert_num_queries(4):  # SELECT, SAVEPOINT, UPDATE, RELEASE
+        with TrafficLightMachine.unit_of_work():
+            result = MyModel.objects.bulk_transition([(green, Green.to_yellow), (red, Red.to_green)])
+            assert result.succeeded == [green, red]
+            assert MyModel.objects.get(id=green.id).state is Green
+    get_lights([1, 1, 0])
+
+    # Other fields changed by transitions are saved as well
+    doc = Document.objects.create(state=Reviewing, review_state=InReview, title="a title")
+    with CaptureQueriesContext(connection) as queries:
+        with TrafficLightMachine.unit_of_work():
+            Yellow(green).to_red()
+            Reviewing(doc).publish()
+    doc = Document.objects.get(id=doc.id)
+    assert (doc.state, doc.review_state, doc.title) == (Published, None, "A Title")
+    assert MyModel.objects.get(id=green.id).state is Red
+    assert [query["sql"].split()[0] for query in queries].count("UPDATE") == 4
+
+    # claim saves in its own transaction, which holds the row locks
+    with TrafficLightMachine.unit_of_work():
+        result = Green.claim(MyModel.objects.all(), 10, Green.to_yellow)
+        assert result.succeeded[0].id == red.id
+        assert MyModel.objects.get(id=red.id).state is Yellow
+    get_lights([0, 1, 1])
+
+    # Machines with auto_save = False are not saved, as outside a unit of work
+    monkeypatch.setattr(TrafficLightMachine, "auto_save", False)
+    with django_assert_num_queries(0):
+        with TrafficLightMachine.unit_of_work():
+            Red(green).to_green()
+    assert green.state is Green
+    assert MyModel.objects.get(id=green.id).state is Red
+
+
+@pytest.mark.django_db
+def test_submachines(django_assert_num_queries):
+    docs = [Document.objects.create(state=Draft, title="a title") for _ in range(3)]
+
+    # Entering the submachine sets the substate in the same bulk transaction
+    with django_assert_num_queries(4):  # SAVEPOINT, 2 UPDATEs, RELEASE
+        result = Document.objects.bulk_transition([(doc, Draft.start_review) for doc in docs])
+    assert result.succeeded == docs
+    assert not result.errors
+    assert list(Document.objects.values_list("state", "review_state")) == [(Reviewing, Drafting)] * 3
+
+    doc = docs[0]
+    assert DocumentMachine.dispatch(doc, "submit") is InReview
+    assert Document.objects.get(id=doc.id).review_state is InReview
+
+    # The substate changed elsewhere, so nothing is saved or changed in memory
+    Document.objects.filter(id=doc.id).update(review_state=Approved)
+    state = Reviewing(doc)
+    with pytest.raises(StateChangedElsewhere):
+        state.publish()
+    assert type(state) is Reviewing
+    assert (doc.state, doc.review_state) == (Reviewing, InReview)
+    saved = Document.objects.get(id=doc.id)
+    assert (saved.state, saved.review_state, saved.title) == (Reviewing, Approved, "a title")
+
+    # Leaving the submachine saves the whole object as usual
+    doc.review_state = Approved
+    Reviewing(doc).publish()
+    saved = Document.objects.get(id=doc.id)
+    assert (saved.state, saved.review_state, saved.title) == (Published, None, "A Title")
+
+
+@pytest.mark.django_db
+def test_regions_q():
+    purchases = {
+        states: Purchase.objects.create(regions=purchase_regions.encode(*states))
+        for states in [(Unpaid, NotShipped), (Settled, NotShipped), (Settled, Shipped), (Refunded, Shipped)]
+    }
+
+    def ids(*states):
+        return set(Purchase.objects.filter(regions_q("regions", *states)).values_list("id", flat=True))
+
+    assert ids(Settled, Shipped) == {purchases[Settled, Shipped].id}
+    assert ids(Shipped) == {purchases[Settled, Shipped].id, purchases[Refunded, Shipped].id}
+    assert ids(Settled) == {purchases[Settled, NotShipped].id, purchases[Settled, Shipped].id}
+    assert len(ids()) == 4
+    assert regions_q("regions", Settled, Shipped) == models.Q(regions=purchase_regions.encode(Settled, Shipped))
+
+    purchase = purchases[Unpaid, NotShipped]
+    Unpaid(purchase).pay()
+    purchase.save()
+    assert ids(Settled, NotShipped) == {purchase.id, purchases[Settled, NotShipped].id}
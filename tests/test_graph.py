@@ -0,0 +1,64 @@
+import json
+from xml.etree import ElementTree
+
+import pytest
+
+from friendly_states.graph import edges, to_dot, to_mermaid, to_graphml, to_json, main, import_machine
+from tests.test_core import TrafficLightMachine
+
+
+def test_edges():
+    assert edges(TrafficLightMachine) == [
+        ("Green", "slow_down", "Yellow"),
+        ("Red", "go", "Green"),
+        ("Yellow", "stop", "Red"),
+    ]
+
+
+def test_formats():
+    assert to_dot(TrafficLightMachine) == '''\
+digraph "TrafficLightMachine" {
+    "Green";
+    "Red";
+    "Yellow";
+    "Green" -> "Yellow" [label="slow_down"];
+    "Red" -> "Green" [label="go"];
+    "Yellow" -> "Red" [label="stop"];
+}
+'''
+
+    assert to_mermaid(TrafficLightMachine) == '''\
+stateDiagram-v2
+    Green
+    Red
+    Yellow
+    Green --> Yellow: slow_down
+    Red --> Green: go
+    Yellow --> Red: stop
+'''
+
+    root = ElementTree.fromstring(to_graphml(TrafficLightMachine))
+    namespace = "{http://graphml.graphdrawing.org/xmlns}"
+    graph = root.find(namespace + "graph")
+    assert [node.get("id") for node in graph.iter(namespace + "node")] == ["Green", "Red", "Yellow"]
+    assert [
+        (edge.get("source"), edge.find(namespace + "data").text, edge.get("target"))
+        for edge in graph.iter(namespace + "edge")
+    ] == edges(TrafficLightMachine)
+
+    data = json.loads(to_json(TrafficLightMachine))
+    assert data["machine"] == "TrafficLightMachine"
+    assert data["states"][0] == {"name": "Green", "slug": "Green", "label": "Green"}
+    assert data["edges"][0] == {"source": "Green", "transition": "slow_down", "target": "Yellow"}
+
+
+def test_cli(capsys, tmp_path):
+    main(["tests.test_core:TrafficLightMachine", "--format", "mermaid"])
+    assert capsys.readouterr().out == to_mermaid(TrafficLightMachine)
+
+    output = tmp_path / "graph.dot"
+    main(["tests.test_core:TrafficLightMachine", "-o", str(output)])
+    assert output.read_text() == to_dot(TrafficLightMachine)
+
+    with pytest.raises(ValueError):
+        import_machine("tests.test_core")
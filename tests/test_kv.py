@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import pytest
+
+from friendly_states.exceptions import StateChangedElsewhere, IncorrectInitialState, TransitionNotAvailable, \
+    GetStateDidNotReturnState
+from friendly_states.kv import KeyValueState, InMemoryClient, bulk_transition, KeyValueClient
+
+
+class LightMachine(KeyValueState):
+    is_machine = True
+    client = InMemoryClient()
+    key_prefix = "light:"
+
+
+class Green(LightMachine):
+    def slow_down(self) -> [Yellow]:
+        pass
+
+
+class Yellow(LightMachine):
+    def stop(self) -> [Red]:
+        pass
+
+
+class Red(LightMachine):
+    def go(self) -> [Green]:
+        pass
+
+
+LightMachine.complete()
+
+
+@pytest.fixture
+def client():
+    client = LightMachine.client
+    client.data.clear()
+    client.round_trips = 0
+    return client
+
+
+def test_transitions(client):
+    Green.initialize(1)
+    assert client.data == {"light:1": "Green"}
+    with pytest.raises(IncorrectInitialState):
+        Red.initialize(1)
+    with pytest.raises(ValueError):
+        LightMachine.initialize(2)
+
+    state = LightMachine(1)
+    assert type(state) is Green
+    state.slow_down()
+    assert client.data == {"light:1": "Yellow"}
+    assert type(LightMachine(1)) is Yellow
+
+    client.data["light:1"] = "Red"
+    with pytest.raises(StateChangedElsewhere):
+        state.stop()
+
+    state = Red(1)
+    client.round_trips = 0
+    state.go()
+    # Check the state, then compare-and-set
+    assert client.round_trips == 2
+    assert client.data == {"light:1": "Green"}
+
+    with pytest.raises(GetStateDidNotReturnState):
+        LightMachine(2)
+    client.data["light:2"] = "Blue"
+    with pytest.raises(GetStateDidNotReturnState, match="Blue"):
+        LightMachine(2)
+
+
+def test_bulk_transition(client):
+    for i in range(5):
+        Green.initialize(i)
+    Red.initialize(5)
+    client.round_trips = 0
+
+    pairs = [(i, Green.slow_down) for i in range(5)] + [
+        (0, Yellow.stop), (5, Green.slow_down), (6, Red.go), (7, "slow_down"),
+    ]
+
+    original_cas_many = client.compare_and_set_many
+
+    def compare_and_set_many(items):
+        # Another process changes one of the lights in between
+        client.data["light:3"] = "Red"
+        return original_cas_many(items)
+
+    client.compare_and_set_many = compare_and_set_many
+    try:
+        result = bulk_transition(pairs)
+    finally:
+        del client.compare_and_set_many
+
+    assert client.round_trips == 2
+    assert result.succeeded == [0, 1, 2, 4, 0]
+    assert [(obj, type(error)) for obj, error in result.errors] == [
+        (7, AttributeError),
+        (5, TransitionNotAvailable),
+        (6, TransitionNotAvailable),
+        (3, StateChangedElsewhere),
+    ]
+    assert result.errors[3][1].state is Green
+    assert client.data == {
+        "light:0": "Red",
+        "light:1": "Yellow",
+        "light:2": "Yellow",
+        "light:3": "Red",
+        "light:4": "Yellow",
+        "light:5": "Red",
+    }
+
+
+def test_default_batch_operations():
+    class DictClient(KeyValueClient):
+        def __init__(self):
+            self.data = {}
+
+        def get(self, key):
+            return self.data.get(key)
+
+        def compare_and_set(self, key, expected, value):
+            if self.data.get(key) != expected:
+                return False
+            self.data[key] = value
+            return True
+
+    client = DictClient()
+    assert client.compare_and_set_many([("a", None, "1"), ("a", None, "2"), ("a", "1", "3")]) == [True, False, True]
+    assert client.get_many(["a", "b"]) == ["3", None]
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.exceptions import IncorrectInitialState, GetStateDidNotReturnState
+from friendly_states.regions import Regions, RegionState
+
+
+class PaymentMachine(RegionState):
+    is_machine = True
+
+
+class Unpaid(PaymentMachine):
+    code = 0
+
+    def pay(self) -> [Paid]:
+        pass
+
+
+class Paid(PaymentMachine):
+    code = 1
+
+    def refund(self) -> [Refunded]:
+        pass
+
+
+class Refunded(PaymentMachine):
+    code = 2
+
+
+PaymentMachine.complete()
+
+
+class ReviewMachine(RegionState):
+    is_machine = True
+
+
+class NotReviewed(ReviewMachine):
+    code = 0
+
+    def review(self) -> [Reviewed]:
+        pass
+
+
+class Reviewed(ReviewMachine):
+    code = 1
+
+
+ReviewMachine.complete()
+
+regions = Regions(PaymentMachine, ReviewMachine, attr_name="combined")
+
+
+def test_encoding():
+    assert regions.bits == 3
+    assert regions.layout == {PaymentMachine: (0, 0b011), ReviewMachine: (2, 0b100)}
+    assert regions.encode(Refunded, Reviewed) == 0b110
+    assert regions.encode(Reviewed, Refunded) == 0b110
+    assert regions.decode(0b110) == (Refunded, Reviewed)
+    assert regions.decode(None) == (None, None)
+    assert regions.get(0b111, PaymentMachine) is None
+    assert regions.replace(0b110, Paid) == 0b101
+    assert regions.pattern(Reviewed) == (0b100, 0b100)
+
+    assert regions.matches(0b101, Paid, Reviewed)
+    assert regions.matches(0b101, Reviewed)
+    assert not regions.matches(0b101, Refunded)
+    assert not regions.matches(None, Refunded)
+
+    with pytest.raises(ValueError):
+        regions.encode(Paid)
+    with pytest.raises(ValueError):
+        regions.encode(Paid, Refunded)
+    with pytest.raises(ValueError):
+        regions.pattern(PaymentMachine)
+    with pytest.raises(ValueError):
+        Regions(PaymentMachine)
+    with pytest.raises(ValueError, match="Can't set Paid without the states of the other regions"):
+        regions.replace(None, Paid)
+
+
+def test_region_state():
+    order = SimpleNamespace(combined=regions.encode(Unpaid, NotReviewed))
+    Unpaid(order).pay()
+    assert order.combined == regions.encode(Paid, NotReviewed)
+    NotReviewed(order).review()
+    Paid(order).refund()
+    assert regions.decode(order.combined) == (Refunded, Reviewed)
+    with pytest.raises(IncorrectInitialState):
+        NotReviewed(order)
+
+    # A new object needs a state in every region first
+    order = SimpleNamespace(combined=None)
+    with pytest.raises(GetStateDidNotReturnState):
+        Unpaid(order)
+    instance, state = PaymentMachine._peek(order)
+    assert state is None
+    with pytest.raises(ValueError, match="give the object a value from encode"):
+        instance.set_state(None, Unpaid)
+    assert order.combined is None
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Integer, create_engine, select, update, DateTime
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+
+from friendly_states.core import guard
+from friendly_states.exceptions import StateChangedElsewhere, TransitionNotAvailable, DuplicateStateCodes
+from friendly_states.sqlalchemy import SQLAlchemyState, StateType, bulk_transition, transition_selected, \
+    transition_clause
+
+
+class LightMachine(SQLAlchemyState):
+    is_machine = True
+
+
+class Green(LightMachine):
+    code = 1
+
+    @guard(lambda light: light.priority != -1)
+    def slow_down(self) -> [Yellow]:
+        pass
+
+
+class Yellow(LightMachine):
+    code = 2
+
+    @guard(lambda light: light.priority, q=lambda entity: entity.priority == 1)
+    def to_green(self) -> [Green]:
+        pass
+
+    def stop(self) -> [Red]:
+        pass
+
+
+class Red(LightMachine):
+    code = 3
+
+    def go(self) -> [Green]:
+        pass
+
+
+LightMachine.complete()
+
+
+class DoorMachine(SQLAlchemyState):
+    is_machine = True
+    changed_at_attr_name = "changed_at"
+
+
+class Open(DoorMachine):
+    def close(self) -> [Closed]:
+        pass
+
+
+class Closed(DoorMachine):
+    def open(self) -> [Open]:
+        pass
+
+
+DoorMachine.complete()
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Light(Base):
+    __tablename__ = "light"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    state = mapped_column(StateType(LightMachine, use_codes=True), nullable=False)
+    priority: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class Door(Base):
+    __tablename__ = "door"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    state = mapped_column(StateType(DoorMachine), nullable=False)
+    changed_at = mapped_column(DateTime, nullable=True)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def db_state(session, obj):
+    return session.execute(
+        select(type(obj).state).where(type(obj).id == obj.id)
+    ).scalar()
+
+
+def test_state_type(session):
+    assert Light.state.type.impl.__class__ is Integer
+    assert Door.state.type.impl.length == len("Closed")
+
+    session.add_all([Light(id=1, state=Green), Light(id=2, state=Red), Door(id=1, state=Open)])
+    session.commit()
+
+    raw = session.connection().exec_driver_sql("SELECT id, state FROM light ORDER BY id").all()
+    assert raw == [(1, 1), (2, 3)]
+    raw = session.connection().exec_driver_sql("SELECT state FROM door").all()
+    assert raw == [("Open",)]
+
+    session.expunge_all()
+    assert session.scalars(select(Light).where(Light.state == Red)).one().id == 2
+    assert session.get(Light, 1).state is Green
+    assert session.get(Door, 1).state is Open
+
+    with pytest.raises(ValueError):
+        StateType(LightMachine.__mro__[1])
+    with pytest.raises(ValueError):
+        StateType(DoorMachine, use_codes=True)
+    with pytest.raises(Exception):
+        session.scalars(select(Light).where(Light.state == "Green")).all()
+
+
+def test_codes():
+    def make_machine(*codes):
+        class Machine(SQLAlchemyState):
+            is_machine = True
+
+        for i, code in enumerate(codes):
+            type(f"S{i}", (Machine,), {} if code is None else {"code": code})
+
+        Machine.complete()
+        return Machine
+
+    with pytest.raises(ValueError):
+        make_machine(0, None)
+
+    with pytest.raises(DuplicateStateCodes):
+        make_machine(0, 0)
+
+    for code in ["1", -1, True]:
+        with pytest.raises(ValueError):
+            make_machine(0, code)
+
+    machine = make_machine(0, 3)
+    assert machine.code_to_state == {0: machine.name_to_state["S0"], 3: machine.name_to_state["S1"]}
+    assert make_machine(None, None).code_to_state == {}
+    assert DoorMachine.code_to_state == {}
+
+
+def test_compare_and_swap(session):
+    light = Light(state=Green)
+    Green(light).slow_down()
+    assert light.state is Yellow
+    session.add(light)
+    session.commit()
+
+    state = Yellow(light)
+    state.stop()
+    assert light.state is Red
+    assert db_state(session, light) is Red
+    assert not session.dirty
+
+    session.execute(update(Light).values(state=Yellow).execution_options(synchronize_session=False))
+    with pytest.raises(StateChangedElsewhere):
+        state.go()
+    assert light.state is Red
+    assert type(state) is Red
+    assert db_state(session, light) is Yellow
+
+    door = Door(state=Open)
+    session.add(door)
+    session.flush()
+    assert door.changed_at is None
+    Open(door).close()
+    assert isinstance(door.changed_at, datetime)
+    session.expire_all()
+    assert door.state is Closed
+    assert door.changed_at is not None
+
+
+def test_bulk_transition(session):
+    lights = [Light(id=i, state=state) for i, state in enumerate([Green, Green, Yellow, Red, Green])]
+    doors = [Door(id=i, state=Open) for i in range(2)]
+    session.add_all(lights + doors)
+    session.commit()
+    session.refresh(lights[4])
+    session.refresh(doors[1])
+    session.execute(update(Light).where(Light.id == 4).values(state=Red).execution_options(synchronize_session=False))
+    session.execute(update(Door).where(Door.id == 1).values(state=Closed).execution_options(synchronize_session=False))
+
+    result = bulk_transition(session, [
+        (lights[0], Green.slow_down),
+        (lights[1], Green.slow_down),
+        (lights[1], Yellow.stop),
+        (lights[2], Yellow.stop),
+        (lights[3], Green.slow_down),
+        (lights[4], Green.slow_down),
+        (doors[0], Open.close),
+        (doors[1], Open.close),
+        (doors[1], Closed.open),
+    ])
+    assert result.succeeded == [lights[0], lights[1], lights[1], lights[2], doors[0]]
+    [(obj1, error1), (obj2, error2), (obj3, error3)] = result.errors
+    assert obj1 is lights[3]
+    assert isinstance(error1, TransitionNotAvailable)
+    assert obj2 is lights[4]
+    assert isinstance(error2, StateChangedElsewhere)
+    assert obj3 is doors[1]
+    assert isinstance(error3, StateChangedElsewhere)
+
+    # The failed door keeps its previous state and timestamp
+    assert doors[1].state is Open
+    assert doors[1].changed_at is None
+    assert isinstance(doors[0].changed_at, datetime)
+
+    assert [light.state for light in lights] == [Yellow, Red, Red, Red, Green]
+    assert not session.dirty
+    session.expire_all()
+    assert [light.state for light in lights] == [Yellow, Red, Red, Red, Red]
+    assert [door.state for door in doors] == [Closed, Closed]
+    assert doors[0].changed_at is not None
+
+
+def test_transition_selected(session):
+    session.add_all([
+        Light(id=1, state=Yellow, priority=1),
+        Light(id=2, state=Yellow, priority=0),
+        Light(id=3, state=Green, priority=1),
+    ])
+    session.commit()
+
+    with pytest.raises(ValueError):
+        transition_clause(Light, Green.slow_down)
+    transition_clause(Light, Green.slow_down, require_q=False)
+
+    result = transition_selected(session, select(Light), Yellow.to_green)
+    assert [light.id for light in result.succeeded] == [1]
+
+    result = transition_selected(session, select(Light).order_by(Light.id), Yellow.stop)
+    assert [light.id for light in result.succeeded] == [2]
+    assert not result.errors
+    assert session.scalars(select(Light).where(Light.state == Red)).all() == result.succeeded
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.core import MappingKeyState
+from friendly_states.exceptions import IncorrectSummary
+from friendly_states.synthetic import generate_machine
+
+
+def test_cycle():
+    generated = generate_machine(3)
+    S0, S1, S2 = generated.states
+    assert generated.machine.states == {S0, S1, S2}
+    assert generated.edges == {"S0": {"S1"}, "S1": {"S2"}, "S2": {"S0"}}
+    assert S0.output_states == {S1}
+
+    thing = SimpleNamespace(state=S0)
+    S0(thing).t0()
+    assert thing.state is S1
+    S1(thing).t0()
+    S2(thing).t0()
+    assert thing.state is S0
+
+
+def test_large():
+    generated = generate_machine(
+        500,
+        fan_out=3,
+        outputs_per_transition=2,
+        abstract_layers=3,
+        abstract_width=4,
+        seed=1,
+    )
+    machine = generated.machine
+    assert len(machine.states) == 500
+    assert len(generated.abstract_states) == 12
+    assert all(state.is_abstract for state in generated.abstract_states)
+
+    for state in generated.states:
+        assert {out.__name__ for out in state.output_states} == generated.edges[state.__name__]
+        # 3 own transitions plus one from each abstract layer
+        assert len(state.transitions) == 6
+
+    # Multiple outputs return the first one
+    S0 = generated.states[0]
+    thing = SimpleNamespace(state=S0)
+    S0(thing).t1()
+    first_output = S0.t1.__annotations__["return"][1:].split(",")[0]
+    assert thing.state.__name__ == first_output
+
+
+def test_base_and_summary():
+    generated = generate_machine(10, fan_out=2, base=MappingKeyState, complete=False)
+    generated.Summary.__annotations__["S0"] = "[S5]"
+    with pytest.raises(IncorrectSummary):
+        generated.machine.complete()
+
+    generated = generate_machine(10, fan_out=2, base=MappingKeyState, slots=True)
+    S0 = generated.states[0]
+    assert S0.__slots__ == ()
+    thing = dict(state=S0)
+    S0(thing).t1()
+    assert thing["state"] is generated.states[2]
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        generate_machine(0)
+
+    with pytest.raises(ValueError):
+        generate_machine(3, outputs_per_transition=4)
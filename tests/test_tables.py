@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import multiprocessing
+import sys
+
+import pytest
+
+from friendly_states.exceptions import StateChangedElsewhere, IncorrectInitialState, GetStateDidNotReturnState
+from friendly_states.tables import TableState, MmapStateTable, SharedMemoryStateTable, code_width
+
+
+class LightMachine(TableState):
+    is_machine = True
+
+
+class Green(LightMachine):
+    code = 0
+
+    def slow_down(self) -> [Yellow]:
+        pass
+
+
+class Yellow(LightMachine):
+    code = 1
+
+    def stop(self) -> [Red]:
+        pass
+
+
+class Red(LightMachine):
+    code = 254
+
+    def go(self) -> [Green]:
+        pass
+
+
+LightMachine.complete()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "states.bin")
+
+
+def test_code_width():
+    assert code_width(LightMachine) == 1
+
+    class Machine(TableState):
+        is_machine = True
+
+    class S1(Machine):
+        code = 255
+
+    Machine.complete()
+    assert code_width(Machine) == 2
+
+    class Machine(TableState):
+        is_machine = True
+
+    class S2(Machine):
+        pass
+
+    Machine.complete()
+    with pytest.raises(ValueError):
+        code_width(Machine)
+
+
+def test_mmap_table(path):
+    with pytest.raises(ValueError):
+        MmapStateTable(path, LightMachine)
+
+    with MmapStateTable(path, LightMachine, size=10) as table:
+        assert len(table) == 10
+        assert table.width == 1
+        assert table.get(0) is None
+        table.set(3, Red)
+        assert table.compare_and_set(3, Red, Green)
+        assert not table.compare_and_set(3, Red, Yellow)
+        assert not table.compare_and_set(3, None, Yellow)
+        assert table.compare_and_set(4, None, Yellow)
+        with pytest.raises(ValueError):
+            table.set(0, LightMachine)
+        for id in [-1, 10]:
+            with pytest.raises(IndexError):
+                table.get(id)
+            with pytest.raises(IndexError):
+                table.set(id, Red)
+            with pytest.raises(IndexError):
+                table.compare_and_set(id, None, Red)
+        assert table.get(9) is None
+
+        with MmapStateTable(path, LightMachine, readonly=True) as reader:
+            assert reader.get(3) is Green
+            table.set(5, Red)
+            assert reader.get(5) is Red
+            assert list(reader.codes[3:6]) == [0, 1, 254]
+            assert reader.codes[0] == reader.empty == 255
+            with pytest.raises(TypeError):
+                reader.set(0, Green)
+
+    with MmapStateTable(path, LightMachine) as table:
+        assert [table.get(i) for i in range(3, 7)] == [Green, Yellow, Red, None]
+
+    with pytest.raises(ValueError):
+        MmapStateTable(path, LightMachine, size=20)
+
+
+def test_table_state(path):
+    LightMachine.table = MmapStateTable(path, LightMachine, size=10)
+    try:
+        Green.initialize(1)
+        with pytest.raises(IncorrectInitialState):
+            Red.initialize(1)
+        with pytest.raises(GetStateDidNotReturnState):
+            LightMachine(2)
+        with pytest.raises(IndexError):
+            Green.initialize(-1)
+
+        state = LightMachine(1)
+        assert type(state) is Green
+        state.slow_down()
+        assert LightMachine.table.get(1) is Yellow
+
+        LightMachine.table.set(1, Red)
+        with pytest.raises(StateChangedElsewhere):
+            state.stop()
+        Red(1).go()
+        assert type(LightMachine(1)) is Green
+    finally:
+        LightMachine.table.close()
+        LightMachine.table = None
+
+
+def initialize_all(table, results):
+    LightMachine.table = table
+    succeeded = 0
+    for i in range(len(table)):
+        try:
+            Green.initialize(i)
+        except IncorrectInitialState:
+            pass
+        else:
+            succeeded += 1
+        try:
+            Green(i).slow_down()
+        except (IncorrectInitialState, StateChangedElsewhere):
+            pass
+        else:
+            succeeded += 1
+    table.close()
+    results.put(succeeded)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="Requires multiprocessing.shared_memory")
+def test_shared_memory_table():
+    context = multiprocessing.get_context("spawn")
+    with SharedMemoryStateTable(LightMachine, size=200, stripes=4, context=context) as table:
+        assert table.get(0) is None
+        results = context.Queue()
+        processes = [context.Process(target=initialize_all, args=(table, results)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        counts = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+
+        # Each ID was initialized once and transitioned once
+        assert sum(counts) == 400
+        assert all(table.get(i) is Yellow for i in range(200))
+
+        table.set(0, Red)
+        assert table.compare_and_set(0, Red, Green)
+        assert table.get(0) is Green
+
+
+def test_as_array(path):
+    numpy = pytest.importorskip("numpy")
+    with MmapStateTable(path, LightMachine, size=5) as table:
+        table.set(1, Red)
+        array = table.as_array()
+        assert array.dtype == numpy.uint8
+        assert list(array) == [255, 254, 255, 255, 255]
+        table.set(2, Yellow)
+        assert array[2] == 1
+        del array
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from friendly_states.core import AttributeState, guard
+from friendly_states.exceptions import TransitionNotAvailable
+from friendly_states.timers import TimeoutScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class OrderMachine(AttributeState):
+    is_machine = True
+
+
+class AwaitingPayment(OrderMachine):
+    timeout = timedelta(minutes=30)
+    on_timeout = "expire"
+
+    def pay(self) -> [Paid]:
+        pass
+
+    @guard(lambda obj: not obj.frozen)
+    def expire(self) -> [Expired]:
+        pass
+
+
+class Paid(OrderMachine):
+    timeout = 60
+    on_timeout = "archive"
+
+    def archive(self) -> [Archived]:
+        pass
+
+
+class Expired(OrderMachine):
+    pass
+
+
+class Archived(OrderMachine):
+    pass
+
+
+OrderMachine.complete()
+
+
+def order(state=AwaitingPayment, frozen=False):
+    return SimpleNamespace(state=state, frozen=frozen)
+
+
+def test_timeouts_metadata():
+    assert OrderMachine.timeouts == {
+        AwaitingPayment: (1800, AwaitingPayment.expire),
+        Paid: (60, Paid.archive),
+    }
+
+
+def test_scheduler():
+    clock = FakeClock()
+    scheduler = TimeoutScheduler(OrderMachine, clock)
+
+    orders = [order() for _ in range(3)]
+    for o in orders:
+        assert scheduler.schedule(o) == 2800
+    assert scheduler.schedule(order(Expired)) is None
+    assert len(scheduler) == 3
+    assert scheduler.next_deadline() == 2800
+
+    clock.now = 2799
+    assert scheduler.fire() == []
+
+    # Paid in the meantime, then the timeout is ignored
+    AwaitingPayment(orders[0]).pay()
+    # Cancelled
+    scheduler.cancel(orders[1])
+    assert len(scheduler) == 2
+
+    clock.now = 2800
+    assert scheduler.fire() == [(orders[2], Expired)]
+    assert orders[2].state is Expired
+    assert orders[0].state is Paid
+    assert orders[1].state is AwaitingPayment
+    assert len(scheduler) == 0
+    assert scheduler.next_deadline() is None
+
+
+def test_reschedule_and_limit():
+    clock = FakeClock()
+    scheduler = TimeoutScheduler(OrderMachine, clock)
+
+    paid = [order(Paid) for _ in range(5)]
+    for i, o in enumerate(paid):
+        scheduler.schedule(o, entered_at=i)
+    frozen = order(frozen=True)
+    scheduler.schedule(frozen, entered_at=0)
+    unfrozen = order()
+    scheduler.schedule(unfrozen, entered_at=100)
+
+    assert scheduler.fire(limit=2) == [(paid[0], Archived), (paid[1], Archived)]
+    assert scheduler.fire(now=62) == [(paid[2], Archived)]
+    assert scheduler.fire() == [(paid[3], Archived), (paid[4], Archived)]
+
+    # The guard rejects the timeout
+    clock.now = 1800
+    assert scheduler.fire() == [(frozen, None)]
+    assert frozen.state is AwaitingPayment
+
+    # After expiring, orders aren't rescheduled since Expired has no timeout
+    clock.now = 1900
+    assert scheduler.fire() == [(unfrozen, Expired)]
+    assert len(scheduler) == 0
+
+    # By default the deadline is relative to the current time
+    o = order()
+    scheduler.schedule(o)
+    clock.now += 1800
+    assert scheduler.fire() == [(o, Expired)]
+
+
+def test_rescheduled_after_transition():
+    class Machine(AttributeState):
+        is_machine = True
+
+    class Ping(Machine):
+        timeout = 10
+        on_timeout = "pong"
+
+        def pong(self) -> [Pong]:
+            pass
+
+    class Pong(Machine):
+        timeout = 5
+        on_timeout = "ping"
+
+        def ping(self) -> [Ping]:
+            pass
+
+    Machine.complete()
+
+    clock = FakeClock()
+    scheduler = TimeoutScheduler(Machine, clock)
+    thing = SimpleNamespace(state=Ping)
+    scheduler.schedule(thing, entered_at=0)
+    assert scheduler.fire(now=20) == [(thing, Pong), (thing, Ping)]
+    assert scheduler.next_deadline() == 25
+
+
+def test_failures_and_retries():
+    clock = FakeClock()
+    scheduler = TimeoutScheduler(OrderMachine, clock, retry_delay=100)
+
+    frozen = order(frozen=True)
+    scheduler.schedule(frozen, entered_at=0)
+    # Saving the new state fails
+    broken_state = property(lambda self: AwaitingPayment, lambda self, value: 1 / 0)
+    broken = type("Broken", (), {"state": broken_state, "frozen": False})()
+    scheduler.schedule(broken, entered_at=0)
+    fine = order()
+    scheduler.schedule(fine, entered_at=0)
+
+    # One failing transition doesn't stop the others
+    clock.now = 1800
+    results = scheduler.fire()
+    assert results[0] == (frozen, None)
+    assert results[1][0] is broken
+    assert isinstance(results[1][1], ZeroDivisionError)
+    assert results[2] == (fine, Expired)
+
+    # Both are retried after retry_delay
+    assert len(scheduler) == 2
+    assert scheduler.next_deadline() == clock.now + 100
+    assert scheduler.fire(now=clock.now + 99) == []
+    frozen.frozen = False
+    results = scheduler.fire(now=clock.now + 100)
+    assert results[0] == (frozen, Expired)
+    assert results[1][0] is broken
+    assert len(scheduler) == 1
+
+    # Without retry_delay, they're reported once and dropped
+    scheduler = TimeoutScheduler(OrderMachine, clock)
+    scheduler.schedule(order(frozen=True), entered_at=0)
+    assert [new_state for _, new_state in scheduler.fire()] == [None]
+    assert len(scheduler) == 0
+
+
+def test_zero_timeout():
+    class Machine(AttributeState):
+        is_machine = True
+
+    class Ping(Machine):
+        timeout = 0
+        on_timeout = "pong"
+
+        def pong(self) -> [Pong]:
+            pass
+
+    class Pong(Machine):
+        timeout = 5
+        on_timeout = "ping"
+
+        def ping(self) -> [Ping]:
+            pass
+
+    with pytest.raises(ValueError, match="The timeout of Ping must be positive, not 0"):
+        Machine.complete()
+
+
+def test_invalid_on_timeout():
+    class Machine(AttributeState):
+        is_machine = True
+
+    class S(Machine):
+        timeout = 10
+        on_timeout = "nothing"
+
+    with pytest.raises(
+            TransitionNotAvailable,
+            match="The state S has a timeout but on_timeout = nothing "
+                  "is not the name of one of its transitions",
+    ):
+        Machine.complete()